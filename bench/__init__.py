@@ -0,0 +1,2 @@
+"""Benchmarks for hitbox-irc-proxy.  Run them from the repository root, e.g.
+``python -m bench.frames``."""
@@ -0,0 +1,198 @@
+# vim: sts=4:sw=4:et:tw=80:nosta
+"""A local stand-in for the parts of the Hitbox API the proxy talks to: the
+chat server list, the socket.io v1 handshake and websocket, and the login
+endpoint.  Chat messages are injected with FakeHitbox.publish(), so the proxy
+can be driven without touching the real servers."""
+import asyncio, json, time
+from aiohttp import web
+from collections import deque
+
+class FakeHitbox:
+
+    """Serves a fake Hitbox API and chat server from one local port.  Every
+    login succeeds, every channel has the same synthetic nick list, and chat
+    messages sent by one connection are relayed to all connections in the
+    channel, as on the real servers.  The last messages of a channel are
+    sent again, flagged as buffered, to every connection joining it."""
+
+    def __init__(self, host="127.0.0.1", port=0, users=100, buffered=20):
+        """Creates a new, stopped fake server.
+            :host: Address to listen on (default 127.0.0.1)
+            :port: Port to listen on, 0 for any free port (default 0)
+            :users: Number of users in each channel's nick list (default 100)
+            :buffered: Number of messages sent on a join (default 20)
+
+        """
+        self.host = host
+        self.port = port
+        self._users = {
+            "admin": [],
+            "user": [],
+            "isSubscriber": [],
+            "anon": ["user{}".format(i) for i in range(users)]
+        }
+        self._channels = {} # channel -> set of websockets
+        self._buffered = buffered
+        self._history = {} # channel -> deque of chatMsg parameters
+        self._runner = None
+        self._tokens = 0
+
+    @property
+    def url(self):
+        """Base URL of the fake API, to be used as config.API_URL."""
+        return "http://{}:{}".format(self.host, self.port)
+
+    @asyncio.coroutine
+    def start(self):
+        """Starts serving.  If no port was given, self.port is set to the
+        port picked by the system."""
+        app = web.Application()
+        app.router.add_route("GET", "/chat/servers", self.servers)
+        app.router.add_route("POST", "/auth/login", self.login)
+        app.router.add_route("GET", "/socket.io/1/", self.handshake)
+        app.router.add_route("GET", "/socket.io/1/websocket/{token}",
+            self.websocket)
+        self._runner = web.AppRunner(app)
+        yield from self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        yield from site.start()
+        self.port = self._runner.addresses[0][1]
+
+    @asyncio.coroutine
+    def stop(self):
+        """Closes all websockets and stops serving."""
+        for sockets in self._channels.values():
+            for ws in list(sockets):
+                yield from ws.close()
+        yield from self._runner.cleanup()
+
+    @asyncio.coroutine
+    def servers(self, request):
+        """GET /chat/servers: this server is the only chat server."""
+        return web.json_response([
+            {"server_ip": "{}:{}".format(self.host, self.port)}
+        ])
+
+    @asyncio.coroutine
+    def login(self, request):
+        """POST /auth/login: any credentials are accepted."""
+        j = json.loads((yield from request.text()))
+        return web.json_response({
+            "authToken": "token-{}".format(j["login"])
+        })
+
+    @asyncio.coroutine
+    def handshake(self, request):
+        """GET /socket.io/1/: hands out a session ID for the websocket."""
+        self._tokens += 1
+        return web.Response(text="{}:60:60:websocket".format(self._tokens))
+
+    @asyncio.coroutine
+    def websocket(self, request):
+        """Serves one chat connection until the proxy closes it."""
+        ws = web.WebSocketResponse()
+        yield from ws.prepare(request)
+        yield from ws.send_str("1::")
+        joined = set()
+        try:
+            while True:
+                msg = yield from ws.receive()
+                if msg.type != web.WSMsgType.TEXT:
+                    break
+                if msg.data.startswith("5:::"):
+                    args = json.loads(msg.data[4:])["args"][0]
+                    yield from self.handle(ws, joined, args["method"],
+                        args["params"])
+        finally:
+            for channel in joined:
+                self._channels[channel].discard(ws)
+        return ws
+
+    @asyncio.coroutine
+    def handle(self, ws, joined, method, params):
+        """Answers a message sent by the proxy.
+            :ws: The websocket it was sent on
+            :joined: Set of the channels joined on the websocket
+            :method: The Hitbox method
+            :params: Dictionary of the message parameters
+
+        """
+        channel = params.get("channel")
+        if method == "joinChannel":
+            joined.add(channel)
+            self._channels.setdefault(channel, set()).add(ws)
+            yield from ws.send_str(self.frame("loginMsg", {
+                "channel": channel,
+                "name": params["name"],
+                "role": "anon"
+            }))
+            for p in list(self._history.get(channel, ())):
+                yield from ws.send_str(self.frame("chatMsg",
+                    dict(p, buffer=True)))
+        elif method == "partChannel":
+            joined.discard(channel)
+            self._channels.get(channel, set()).discard(ws)
+        elif method == "getChannelUserList":
+            yield from ws.send_str(self.frame("userList", {
+                "channel": channel,
+                "data": self._users
+            }))
+        elif method == "chatMsg":
+            yield from self.publish(channel, params["name"], params["text"])
+
+    @staticmethod
+    def frame(method, params):
+        """Builds a socket.io message frame the way Hitbox does, with the
+        message itself JSON encoded as a string inside the frame."""
+        return "5:::" + json.dumps({
+            "name": "message",
+            "args": [json.dumps({"method": method, "params": params})]
+        })
+
+    @asyncio.coroutine
+    def publish(self, channel, name, text):
+        """Sends a chat message to every connection in a channel.
+            :channel: The channel
+            :name: Nick of the sender
+            :text: The message
+            :returns: The number of connections it was sent to
+
+        """
+        sockets = self._channels.get(channel, ())
+        params = {
+            "channel": channel,
+            "name": name,
+            "nameColor": "D44F38",
+            "text": text,
+            "time": int(time.time()),
+            "role": "anon",
+            "isFollower": False,
+            "isSubscriber": False,
+            "isOwner": False,
+            "isStaff": False,
+            "isCommunity": False,
+            "media": False,
+            "image": "",
+            "buffer": False
+        }
+        history = self._history.get(channel)
+        if history == None:
+            history = self._history[channel] = deque(maxlen=self._buffered)
+        history.append(params)
+        frame = self.frame("chatMsg", params)
+        for ws in list(sockets):
+            yield from ws.send_str(frame)
+        return len(sockets)
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    fake = FakeHitbox(port=8778)
+    loop.run_until_complete(fake.start())
+    print("Fake Hitbox API at {}".format(fake.url))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(fake.stop())
+        loop.close()
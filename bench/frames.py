@@ -0,0 +1,70 @@
+# vim: sts=4:sw=4:et:tw=80:nosta
+"""Micro-benchmark of the frame encoder against building each frame as a
+nested dictionary and encoding it with json.dumps, the way every HitboxClient
+command used to."""
+import json, sys, timeit
+import hitbox_frames
+
+def legacy_chat(channel, nick, color, text):
+    """Builds a chatMsg frame the old way."""
+    prefix = "5:::"
+    j = json.dumps({
+        "name": "message",
+        "args": [
+            {
+                "method": "chatMsg",
+                "params": {
+                    "channel": channel,
+                    "name": nick,
+                    "nameColor": color,
+                    "text": text
+                }
+            }
+        ]
+    })
+    return prefix + j
+
+def legacy_timeout(channel, token, nick, time):
+    """Builds a kickUser frame the old way."""
+    prefix = "5:::"
+    j = json.dumps({
+        "name": "message",
+        "args": [
+            {
+                "method": "kickUser",
+                "params": {
+                    "channel": channel,
+                    "name": nick,
+                    "token": token,
+                    "timeout": time
+                }
+            }
+        ]
+    })
+    return prefix + j
+
+def run(number):
+    """Times both approaches and prints the cost per frame.
+        :number: Frames to encode per measurement
+
+    """
+    enc = hitbox_frames.FrameEncoder("somechannel", "somenick",
+        "0123456789abcdef0123456789abcdef", "D44F38")
+    text = "Hello chat, this is a fairly ordinary message Kappa"
+    cases = [
+        ("chatMsg (legacy)", lambda: legacy_chat("somechannel", "somenick",
+            "D44F38", text)),
+        ("chatMsg (chat)", lambda: enc.chat(text)),
+        ("chatMsg (encode)", lambda: enc.encode("sendMessage",
+            {"text": text})),
+        ("kickUser (legacy)", lambda: legacy_timeout("somechannel",
+            "0123456789abcdef0123456789abcdef", "troll", 300)),
+        ("kickUser (encode)", lambda: enc.encode("timeout",
+            {"nick": "troll", "time": 300})),
+    ]
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=number, repeat=5))
+        print("{:<20} {:8.0f} ns/frame".format(name, best / number * 1e9))
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,178 @@
+# vim: sts=4:sw=4:et:tw=80:nosta
+"""End-to-end benchmark of the proxy.  A fake Hitbox backend (see
+bench.fake_hitbox) and the IRC server run in this process; scripted IRC
+clients register, join channels and read chat while the fake backend
+publishes timestamped messages into them.  Reports the delivered messages per
+second, the p50/p99 latency from publishing a message to an IRC client
+reading it, and the memory used per joined channel."""
+import argparse, asyncio, time, tracemalloc
+import config
+from bench.fake_hitbox import FakeHitbox
+
+class BenchClient:
+
+    """A scripted IRC client.  Registers, joins its channels and records the
+    latency of every benchmark message it reads."""
+
+    def __init__(self, nick, channels):
+        """Creates a new, unconnected client.
+            :nick: Nick to register with
+            :channels: List of channels to join
+
+        """
+        self.nick = nick
+        self.channels = channels
+        self.received = 0
+        self.latencies = []
+        self._joined = set()
+        self._welcome = asyncio.Event()
+        self._alljoined = asyncio.Event()
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self._error = None
+
+    @asyncio.coroutine
+    def connect(self, port):
+        """Connects to the proxy and joins all channels.
+            :port: Port of the IRC server
+
+        """
+        self._reader, self._writer = yield from asyncio.open_connection(
+            "127.0.0.1", port)
+        self._writer.write("PASS bench\nNICK {}\nUSER {} 0 * :{}\n"
+            .format(self.nick, self.nick, self.nick).encode("UTF-8"))
+        self._task = asyncio.async(self.read())
+        yield from self._welcome.wait()
+        self._writer.write("JOIN {}\n".format(",".join("#" + c
+            for c in self.channels)).encode("UTF-8"))
+        yield from self._alljoined.wait()
+        if self._error != None:
+            raise IOError(self._error)
+
+    @asyncio.coroutine
+    def read(self):
+        """Reads lines from the proxy until the connection is closed."""
+        join = ":{}!{}@hitbox_irc_proxy JOIN :#".format(self.nick, self.nick)
+        while True:
+            line = yield from self._reader.readline()
+            if not line:
+                break
+            line = line.decode("UTF-8").rstrip("\r\n")
+            if " PRIVMSG " in line:
+                text = line.split(" :", 1)[1]
+                if text.startswith("bench "):
+                    self.received += 1
+                    self.latencies.append(time.perf_counter() -
+                        float(text[6:]))
+            elif line.startswith(join):
+                self._joined.add(line[len(join):])
+                if len(self._joined) == len(self.channels):
+                    self._alljoined.set()
+            elif " 001 " in line:
+                self._welcome.set()
+            elif " 437 " in line or " 464 " in line:
+                self._error = line
+                self._welcome.set()
+                self._alljoined.set()
+
+    def close(self):
+        """Disconnects from the proxy."""
+        self._writer.write(b"QUIT\n")
+        self._writer.close()
+        self._task.cancel()
+
+def percentile(values, p):
+    """Returns the p-th percentile of a list of values."""
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+@asyncio.coroutine
+def run(args):
+    """Runs one benchmark and prints its results.
+        :args: The parsed command line arguments
+
+    """
+    loop = asyncio.get_event_loop()
+    fake = FakeHitbox(users=args.users)
+    yield from fake.start()
+    config.API_URL = fake.url
+    config.eventQueueSize = max(config.eventQueueSize, args.messages)
+
+    # Imported late so that the proxy picks up the fake API
+    import hitbox_http
+    from hitbox_irc_server import IRCServerProtocol
+    server = yield from loop.create_server(IRCServerProtocol, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    channels = ["bench{}".format(i) for i in range(args.channels)]
+    clients = [BenchClient("bencher{}".format(i), channels)
+        for i in range(args.clients)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for c in clients:
+        yield from c.connect(port)
+    joined = len(clients) * len(channels)
+    perchannel = (tracemalloc.get_traced_memory()[0] - before) / joined
+    tracemalloc.stop()
+
+    expected = joined * args.messages
+    start = time.perf_counter()
+    for i in range(args.messages):
+        for channel in channels:
+            yield from fake.publish(channel, "streamer",
+                "bench {!r}".format(time.perf_counter()))
+        if args.rate:
+            yield from asyncio.sleep(1 / args.rate)
+        elif i % 100 == 99:
+            # Let the proxy catch up now and then
+            yield from asyncio.sleep(0)
+
+    received = 0
+    idle = 0
+    while received < expected and idle < args.timeout * 10:
+        yield from asyncio.sleep(0.1)
+        now = sum(c.received for c in clients)
+        idle = 0 if now > received else idle + 1
+        received = now
+    elapsed = time.perf_counter() - start - idle / 10
+
+    latencies = [l for c in clients for l in c.latencies]
+    print("clients {}, channels {}, messages {} per channel".format(
+        args.clients, args.channels, args.messages))
+    print("delivered    {} of {}".format(received, expected))
+    print("throughput   {:.0f} msgs/sec".format(received / elapsed))
+    print("latency p50  {:.2f} ms".format(percentile(latencies, 50) * 1000))
+    print("latency p99  {:.2f} ms".format(percentile(latencies, 99) * 1000))
+    print("memory       {:.1f} KiB per joined channel".format(
+        perchannel / 1024))
+
+    for c in clients:
+        c.close()
+    yield from asyncio.sleep(0.5)
+    server.close()
+    yield from server.wait_closed()
+    yield from fake.stop()
+    yield from hitbox_http.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=5,
+        help="IRC clients, each joining every channel (default 5)")
+    parser.add_argument("--channels", type=int, default=10,
+        help="channels to join (default 10)")
+    parser.add_argument("--messages", type=int, default=1000,
+        help="messages published per channel (default 1000)")
+    parser.add_argument("--rate", type=float, default=0,
+        help="messages per second and channel, 0 for as fast as possible "
+        "(default 0)")
+    parser.add_argument("--users", type=int, default=100,
+        help="users in each channel's nick list (default 100)")
+    parser.add_argument("--timeout", type=float, default=5,
+        help="seconds to wait for stragglers (default 5)")
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(parser.parse_args()))
+    loop.close()
@@ -1,6 +1,116 @@
 import logging
 
 API_URL = "https://api.hitbox.tv"
-logLevel = logging.DEBUG
+ircPort = 7778
+logLevel = logging.INFO
 logFormat = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
+# Log records waiting for the logging thread before new ones are dropped, and
+# the fraction of lines kept by the per-line traffic loggers (1 keeps all)
+logQueueSize = 10000
+logSampling = {
+    "irc.traffic": 1.0,
+    "ws.traffic": 0.1
+}
+
+# Login token cache: seconds a token is reused for, number of accounts kept,
+# and how long before expiry a background refresh is started
+tokenTTL = 3600
+tokenCacheSize = 256
+tokenRefreshAhead = 300
+
+# Chat server directory: seconds the server list is cached for, seconds a
+# failing server is avoided, and how many of the fastest servers to pick from
+serverListTTL = 300
+serverErrorPenalty = 60
+serverChoices = 2
+
+# Shared HTTP client: total and per-host pooled connections, seconds an idle
+# connection is kept alive, and seconds to wait for a response
+httpMaxConnections = 100
+httpConnectionsPerHost = 10
+httpKeepAlive = 30
+httpTimeout = 10
+
+# Inbound event queue per channel: maximum queued events and what to do when
+# it is full ("drop", "coalesce" or "pause", see hitbox_irc_socket.EventQueue)
+eventQueueSize = 1000
+eventQueuePolicy = "coalesce"
+
+# Number of channels of one account sharing a single Hitbox websocket
+channelsPerConnection = 10
+
+# Reconnecting dropped websockets: seconds before the first attempt, the
+# longest wait between attempts (the wait doubles after each failure), the
+# random jitter applied to it (as a fraction), and the number of attempts
+# before the channels are given up (0 to never give up)
+reconnectDelay = 1
+reconnectMaxDelay = 60
+reconnectJitter = 0.5
+reconnectAttempts = 10
+
+# Nick list refreshes: base, shortest and longest seconds between refreshes of
+# a channel, the random jitter applied to them (as a fraction), the number of
+# users above which a channel is refreshed less often, and the chat messages
+# per second above which it is refreshed more often
+nickListInterval = 10
+nickListMinInterval = 5
+nickListMaxInterval = 120
+nickListJitter = 0.2
+nickListLargeChannel = 1000
+nickListBusyRate = 1.0
+
+# Slow IRC clients: bytes buffered for a client before it is considered slow
+# and once it has caught up again, what to do with chat in the meantime
+# ("wait", "drop" or "summarise", see IRCServerProtocol.pause_writing), and
+# seconds a client may stay slow before it is disconnected (0 to never)
+clientHighWater = 256 * 1024
+clientLowWater = 64 * 1024
+slowClientPolicy = "summarise"
+slowClientTimeout = 60
+
+# Metrics endpoint: address and port serving the Prometheus text format at
+# /metrics (port 0 disables it; the STATS command works either way)
+metricsHost = "127.0.0.1"
+metricsPort = 9778
+
+# Worker processes: number of processes serving IRC clients (1 runs everything
+# in a single process, 0 starts one per CPU), seconds between the metrics
+# reports of each worker, and seconds a stopping worker waits for its clients
+# to leave (see hitbox_workers)
+workers = 1
+workerStatsInterval = 5
+workerDrainTimeout = 300
+
+# Chat history: messages remembered per channel and replayed to IRC clients
+# joining it, seconds they are remembered for, and the number of channels
+# whose history is kept after everyone left them
+historySize = 100
+historyAge = 3600
+historyChannels = 1000
+
+# Fingerprints of recent chat messages remembered per channel, to drop
+# messages Hitbox sends again after a rejoin or reconnect
+dedupeSize = 512
+
+# Chat sent by IRC clients: longest message Hitbox accepts (longer ones are
+# split), messages sent at once and per second afterwards (slow mode may
+# lower this), and messages per channel waiting to be sent before new ones
+# are dropped
+messageLength = 300
+sendBurst = 3
+sendRate = 1.0
+sendQueueSize = 20
+
+# Websockets this process may open to Hitbox (0 for no limit), and how many
+# of them one user may hold.  JOINs needing a new websocket while all are in
+# use wait in line, up to joinQueueSize of them, for at most joinWaitTimeout
+# seconds; users take turns getting the websockets that free up
+maxConnections = 200
+userConnections = 10
+joinQueueSize = 500
+joinWaitTimeout = 60
+
+# Channels of one IRC session connecting at the same time, e.g. when a client
+# joins its whole autojoin list with one JOIN
+joinConcurrency = 10
@@ -0,0 +1,163 @@
+# vim: sts=4:sw=4:et:tw=80:nosta
+"""Encoding of the socket.io frames sent to Hitbox chat.  Every command is
+described once in COMMANDS; a FrameEncoder turns each description into a
+template for its channel, so that sending a command only has to JSON encode
+the values that change between calls."""
+import json
+from datetime import datetime
+
+# Socket.io heartbeat reply
+PONG = "2::"
+
+# Substituted by the encoder: the channel, the user's nick, the nick used to
+# log in (UnknownSoldier for anonymous users), the login token, the name color
+# and the current timestamp.  Any other string names an argument of the
+# command, and anything that is not a string is sent as is.
+CHANNEL = "@channel"
+NICK = "@nick"
+LOGIN = "@login"
+TOKEN = "@token"
+COLOR = "@color"
+TIME = "@time"
+
+# command -> (Hitbox method, ((parameter, value), ...))
+COMMANDS = {
+    "joinChannel": ("joinChannel", (("channel", CHANNEL), ("name", LOGIN),
+        ("token", TOKEN), ("isAdmin", False))),
+    "partChannel": ("partChannel", (("channel", CHANNEL), ("name", LOGIN))),
+    "userList": ("getChannelUserList", (("channel", CHANNEL),)),
+    "userInfo": ("getChannelUser", (("channel", CHANNEL), ("name", "nick"))),
+    "timeout": ("kickUser", (("channel", CHANNEL), ("name", "nick"),
+        ("token", TOKEN), ("timeout", "time"))),
+    "ban": ("banUser", (("channel", CHANNEL), ("name", "nick"))),
+    "ipban": ("banUser", (("channel", CHANNEL), ("name", "nick"),
+        ("token", TOKEN), ("banIP", True))),
+    "unban": ("unbanUser", (("channel", CHANNEL), ("name", "nick"),
+        ("token", TOKEN))),
+    "addMod": ("makeMod", (("channel", CHANNEL), ("name", "nick"),
+        ("token", TOKEN))),
+    "removeMod": ("removeMod", (("channel", CHANNEL), ("name", "nick"),
+        ("token", TOKEN))),
+    "setSlow": ("slowMode", (("channel", CHANNEL), ("time", "time"))),
+    "enableSubOnly": ("slowMode", (("channel", CHANNEL), ("subscriber", True),
+        ("rate", 0))),
+    "disableSubOnly": ("slowMode", (("channel", CHANNEL),
+        ("subscriber", False), ("rate", 0))),
+    "sendMessage": ("chatMsg", (("channel", CHANNEL), ("name", NICK),
+        ("nameColor", COLOR), ("text", "text"))),
+    "sendDM": ("directMsg", (("channel", CHANNEL), ("from", NICK),
+        ("to", "nick"), ("nameColor", COLOR), ("text", "text"))),
+    "setSticky": ("motdMsg", (("channel", CHANNEL), ("name", NICK),
+        ("nameColor", COLOR), ("text", "msg"), ("time", TIME))),
+    "startPoll": ("createPoll", (("channel", CHANNEL), ("question", "question"),
+        ("choices", "choices"), ("subscribersOnly", "subscribersOnly"),
+        ("followersOnly", "followersOnly"), ("start_time", TIME),
+        ("nameColor", COLOR))),
+    "pollVote": ("voteMsg", (("name", NICK), ("channel", CHANNEL),
+        ("choice", "choice"), ("token", TOKEN))),
+    "pausePoll": ("pausePoll", (("channel", CHANNEL), ("token", TOKEN))),
+    "restartPoll": ("startPoll", (("channel", CHANNEL), ("token", TOKEN))),
+    "endPoll": ("endPoll", (("channel", CHANNEL), ("token", TOKEN))),
+    "createRaffle": ("createRaffle", (("channel", CHANNEL),
+        ("question", "question"), ("prize", "prize"), ("choices", "choices"),
+        ("subscribersOnly", "subscribersOnly"),
+        ("followersOnly", "followersOnly"), ("start_time", TIME),
+        ("nameColor", COLOR))),
+    "pauseRaffle": ("pauseRaffle", (("channel", CHANNEL),)),
+    "endRaffle": ("endRaffle", (("channel", CHANNEL),)),
+    "restartRaffle": ("startRaffle", (("channel", CHANNEL),)),
+    "raffleVote": ("voteRaffle", (("name", NICK), ("channel", CHANNEL),
+        ("choice", "choice"))),
+    "pickRaffleWinner": ("winnerRaffle", (("channel", CHANNEL),
+        ("answer", "choice"))),
+    "hideRaffle": ("hideRaffle", (("channel", CHANNEL),)),
+    "cleanupRaffle": ("cleanupRaffle", (("channel", CHANNEL),)),
+}
+
+_dumps = json.JSONEncoder(separators=(",", ":")).encode
+
+def timestamp():
+    """Obtains the current timestamp in the format that the Hitbox API needs
+    it in."""
+    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+class FrameEncoder:
+
+    """Builds the frames of the COMMANDS for one channel and user.  The
+    channel, nick, token and color never change, so they are encoded into the
+    template of each command the first time it is used; afterwards only the
+    arguments of a call are encoded."""
+
+    def __init__(self, channel, nick=None, logintoken=None, namecolor=None):
+        """Creates a new encoder.
+            :channel: The channel commands are sent to
+            :nick: The user's Hitbox nickname (default None)
+            :logintoken: The user's login token (default None)
+            :namecolor: The user's name color (default None)
+
+        """
+        self._context = {
+            CHANNEL: channel,
+            NICK: nick,
+            LOGIN: "UnknownSoldier" if nick == None else nick,
+            TOKEN: logintoken,
+            COLOR: namecolor
+        }
+        self._templates = {}
+        self._chat = self._compile("sendMessage")
+
+    def _compile(self, command):
+        """Builds the template of a command.
+            :command: Name of the command in COMMANDS
+            :returns: A tuple of the literal pieces of the frame and the
+                names of the values between them
+
+        """
+        method, params = COMMANDS[command]
+        pieces = []
+        slots = []
+        lit = '5:::{"name":"message","args":[{"method":' + _dumps(method) + \
+            ',"params":{'
+        for i, (key, value) in enumerate(params):
+            lit += ("," if i else "") + _dumps(key) + ":"
+            if not isinstance(value, str):
+                lit += _dumps(value)
+            elif value in self._context:
+                lit += _dumps(self._context[value])
+            else:
+                pieces.append(lit)
+                slots.append(value)
+                lit = ""
+        pieces.append(lit + "}}]}")
+        template = (tuple(pieces), tuple(slots))
+        self._templates[command] = template
+        return template
+
+    def encode(self, command, args=None):
+        """Builds the frame of a command.
+            :command: Name of the command in COMMANDS
+            :args: Dictionary of the command's arguments (default None)
+            :returns: The frame, ready to be sent
+
+        """
+        template = self._templates.get(command)
+        if template == None:
+            template = self._compile(command)
+        pieces, slots = template
+        if not slots:
+            return pieces[0]
+        out = [pieces[0]]
+        for i, slot in enumerate(slots):
+            out.append(_dumps(timestamp() if slot == TIME else args[slot]))
+            out.append(pieces[i + 1])
+        return "".join(out)
+
+    def chat(self, text):
+        """Builds the frame of a chat message.  Same as encoding sendMessage,
+        but faster.
+            :text: Text to send
+            :returns: The frame, ready to be sent
+
+        """
+        pieces = self._chat[0]
+        return pieces[0] + _dumps(text) + pieces[1]
@@ -1,12 +1,17 @@
 # vim: sts=4:sw=4:et:tw=80:nosta
-import config, logging, json, requests, sys
+import asyncio, config, hashlib, hitbox_http, hitbox_logging, hitbox_metrics
+import json, logging, sys
+from collections import OrderedDict
 
+@asyncio.coroutine
 def obtain_token(user, password):
     """Attempts to grab a login token from Hitbox with the given username and
-    password.
+    password.  The request is made asynchronously, so other connections keep
+    running while the auth API answers.
         :user: Username to login with
         :password: Password to login with
-    
+        :returns: The login token, or None if authentication failed
+
     """
     log = logging.getLogger("token")
     j = json.dumps({
@@ -15,10 +20,23 @@ def obtain_token(user, password):
         "rememberme": ""
     })
     log.debug("Making request to /auth/login")
-    r = requests.post("{}/auth/login".format(config.API_URL), data=j)
-    j = r.json()
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    try:
+        d = yield from hitbox_http.request("POST",
+            "{}/auth/login".format(config.API_URL), data=j)
+    except IOError as e:
+        # Hitbox answers a failed login with a client error status
+        if not e.args or not isinstance(e.args[0], int) or e.args[0] >= 500:
+            raise
+        log.error("Authentication failed ({}).".format(e))
+        return None
+    finally:
+        hitbox_metrics.auth_latency.observe(loop.time() - start)
+    j = json.loads(d.decode("UTF-8"))
 
-    if "error_msg" in j and j["error_msg"] == "auth_failed":
+    if "authToken" not in j or \
+        ("error_msg" in j and j["error_msg"] == "auth_failed"):
         log.error("Authentication failed.")
         return None
     else:
@@ -26,28 +44,122 @@ def obtain_token(user, password):
         log.info("Your authentication token is: " + j["authToken"])
         return j["authToken"]
 
+class TokenCache:
+
+    """Caches login tokens so that reconnects and multiple sessions for the
+    same account reuse a valid token instead of logging in again.  Entries are
+    keyed by username and a hash of the password, expire after a fixed TTL and
+    are evicted least recently used first once the cache is full.  A token
+    that is close to expiring is still handed out while a fresh one is fetched
+    in the background."""
+
+    def __init__(self, ttl=None, maxsize=None, refresh=None):
+        """Creates a new, empty token cache.
+            :ttl: Seconds a token is considered valid (default
+                config.tokenTTL)
+            :maxsize: Maximum number of cached tokens (default
+                config.tokenCacheSize)
+            :refresh: Seconds before expiry at which a background refresh is
+                started (default config.tokenRefreshAhead)
+
+        """
+        self._ttl = config.tokenTTL if ttl == None else ttl
+        self._maxsize = config.tokenCacheSize if maxsize == None else maxsize
+        self._refresh = config.tokenRefreshAhead if refresh == None \
+            else refresh
+        self._entries = OrderedDict() # key -> (token, expiry time)
+        self._pending = {} # key -> future of an in-flight login
+        self._log = logging.getLogger("token")
+
+    @staticmethod
+    def _key(user, password):
+        """Builds the cache key for a set of credentials.  The password itself
+        is never stored."""
+        h = hashlib.sha256(password.encode("UTF-8")).hexdigest()
+        return (user.lower(), h)
+
+    @asyncio.coroutine
+    def get(self, user, password):
+        """Returns a login token for the given credentials, logging in only if
+        no valid token is cached.  Concurrent calls for the same credentials
+        share a single login request.
+            :user: Username to login with
+            :password: Password to login with
+            :returns: The login token, or None if authentication failed
+
+        """
+        key = self._key(user, password)
+        now = asyncio.get_event_loop().time()
+        entry = self._entries.get(key)
+        if entry != None:
+            token, expires = entry
+            if expires > now:
+                self._entries.move_to_end(key)
+                if expires - now < self._refresh and key not in self._pending:
+                    self._log.debug("Refreshing token for {} ahead of expiry"
+                        .format(user))
+                    self._login(key, user, password)
+                return token
+            del self._entries[key]
+
+        fut = self._pending.get(key)
+        if fut == None:
+            fut = self._login(key, user, password)
+        return (yield from asyncio.shield(fut))
+
+    def _login(self, key, user, password):
+        """Starts a login request for the given credentials and stores its
+        result once it completes.
+            :returns: A future resolving to the token (or None)
+
+        """
+        fut = asyncio.async(obtain_token(user, password))
+        self._pending[key] = fut
+
+        def done(f):
+            del self._pending[key]
+            if f.cancelled() or f.exception() != None or f.result() == None:
+                return
+            self.put(key, f.result())
+        fut.add_done_callback(done)
+        return fut
+
+    def put(self, key, token):
+        """Stores a token in the cache, evicting the least recently used
+        entries if the cache is full.
+            :key: Cache key as built by _key()
+            :token: The login token
+
+        """
+        self._entries[key] = (token, asyncio.get_event_loop().time() +
+            self._ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user, password):
+        """Removes the cached token for the given credentials, e.g. after
+        Hitbox rejected it."""
+        self._entries.pop(self._key(user, password), None)
+
+tokens = TokenCache()
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    if len(sys.argv) < 3:
         print("Usage: python hitbox_get_user_token.py <nick> <pass>")
         print()
         print("nick - Hitbox username")
         print("pass - Hitbox password")
+        sys.exit(1)
     else:
         nick = sys.argv[1]
         password = sys.argv[2]
 
-    logs = [logging.getLogger(x) for x in ["asyncio", "token"]]
-    ch = logging.StreamHandler()
-    ch.setLevel(config.logLevel)
-    formatter = logging.Formatter(config.logFormat)
-    ch.setFormatter(formatter)
-    for x in logs:
-        x.setLevel(config.logLevel)
-        x.addHandler(ch)
+    hitbox_logging.setup(["asyncio", "token", "http"])
 
     loop = asyncio.get_event_loop()
     try:
         loop.run_until_complete(obtain_token(nick, password))
     finally:
+        loop.run_until_complete(hitbox_http.close())
         loop.close()
-
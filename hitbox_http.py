@@ -0,0 +1,60 @@
+# vim: sts=4:sw=4:et:tw=80:nosta
+"""Shared HTTP client used for every REST and socket.io handshake request, so
+connections to the Hitbox API and chat servers are kept alive and reused."""
+import aiohttp, asyncio, config, logging
+
+_session = None
+
+def get_session():
+    """Returns the shared client session, creating it on first use.
+        :returns: An aiohttp.ClientSession
+
+    """
+    global _session
+    if _session == None or _session.closed:
+        logging.getLogger("http").debug("Creating shared HTTP session")
+        connector = aiohttp.TCPConnector(
+            limit=config.httpMaxConnections,
+            limit_per_host=config.httpConnectionsPerHost,
+            keepalive_timeout=config.httpKeepAlive)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+@asyncio.coroutine
+def _fetch(method, url, kwargs):
+    """Performs a request and reads the whole response body."""
+    r = yield from get_session().request(method, url, **kwargs)
+    try:
+        if r.status >= 400:
+            raise IOError(r.status)
+        d = yield from r.read()
+    finally:
+        r.release()
+    return d
+
+@asyncio.coroutine
+def request(method, url, timeout=None, **kwargs):
+    """Performs an HTTP request on a pooled connection.
+        :method: HTTP method
+        :url: URL to request
+        :timeout: Seconds to wait for the whole response (default
+            config.httpTimeout)
+        :returns: The response body as bytes
+
+    Raises IOError with the status code if the server answered with an error,
+    and asyncio.TimeoutError if it did not answer in time.  Any further
+    keyword arguments are passed to aiohttp.
+
+    """
+    if timeout == None:
+        timeout = config.httpTimeout
+    return (yield from asyncio.wait_for(_fetch(method, url, kwargs), timeout))
+
+@asyncio.coroutine
+def close():
+    """Closes the shared session and all of its pooled connections.  Should be
+    called once before the event loop is closed."""
+    global _session
+    if _session != None:
+        session, _session = _session, None
+        yield from session.close()
@@ -0,0 +1,161 @@
+# vim: sts=4:sw=4:et:tw=80:nosta
+"""Incremental framing and parsing of the RFC 1459 lines sent by IRC
+clients."""
+from datetime import datetime, timezone
+
+# RFC 1459 limits a line to 512 bytes including the CRLF.  IRCv3 tags may add
+# up to 8191 bytes in front of that, so anything longer is garbage.
+MAX_LINE = 8191 + 512
+
+class IRCMessage:
+
+    """A single parsed IRC line."""
+
+    __slots__ = ("tags", "prefix", "command", "params")
+
+    def __init__(self, tags, prefix, command, params):
+        """Creates a new message.
+            :tags: Dictionary of IRCv3 message tags, or None
+            :prefix: Source prefix without the leading colon, or None
+            :command: Lowercased command name
+            :params: List of parameters, trailing parameter included
+
+        """
+        self.tags = tags
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+
+    def __repr__(self):
+        return "IRCMessage({!r}, {!r}, {!r}, {!r})".format(self.tags,
+            self.prefix, self.command, self.params)
+
+def parse_tags(raw):
+    """Parses the IRCv3 tag section of a line.
+        :raw: Tag string without the leading @
+        :returns: A dictionary of tag names to (unescaped) values
+
+    """
+    tags = {}
+    for item in raw.split(";"):
+        if not item:
+            continue
+        key, _, value = item.partition("=")
+        if "\\" in value:
+            value = value.replace("\\:", ";").replace("\\s", " ") \
+                .replace("\\r", "\r").replace("\\n", "\n") \
+                .replace("\\\\", "\\")
+        tags[key] = value
+    return tags
+
+def parse_line(line):
+    """Parses a single line into an IRCMessage in one pass.
+        :line: Decoded line, without the trailing newline
+        :returns: An IRCMessage, or None if the line holds no command
+
+    """
+    tags = None
+    prefix = None
+    if line[:1] == "@":
+        raw, _, line = line[1:].partition(" ")
+        tags = parse_tags(raw)
+        line = line.lstrip(" ")
+    if line[:1] == ":":
+        prefix, _, line = line[1:].partition(" ")
+    if line[:1] == ":":
+        return None
+    middle, sep, trailing = line.partition(" :")
+    params = middle.split()
+    if not params:
+        return None
+    command = params.pop(0).lower()
+    if sep:
+        params.append(trailing)
+    return IRCMessage(tags, prefix, command, params)
+
+def format_tags(tags):
+    """Builds the IRCv3 tag section of a line.
+        :tags: Dictionary of tag names to values (None for tags without one)
+        :returns: Tag string without the leading @
+
+    """
+    out = []
+    for key, value in tags.items():
+        if value == None or value == "":
+            out.append(key)
+            continue
+        value = str(value)
+        if any(c in value for c in "\\; \r\n"):
+            value = value.replace("\\", "\\\\").replace(";", "\\:") \
+                .replace(" ", "\\s").replace("\r", "\\r") \
+                .replace("\n", "\\n")
+        out.append(key + "=" + value)
+    return ";".join(out)
+
+def format_server_time(t):
+    """Formats a Unix time as an IRCv3 server-time timestamp.
+        :t: The Unix time
+        :returns: The timestamp, e.g. 2016-05-06T15:40:00.000Z
+
+    """
+    return datetime.fromtimestamp(t, timezone.utc) \
+        .strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+def parse_server_time(value):
+    """Parses an IRCv3 server-time timestamp, e.g. 2016-05-06T15:40:00.000Z.
+        :value: The timestamp
+        :returns: The Unix time, or None if the timestamp is invalid
+
+    """
+    try:
+        t = datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+    except ValueError:
+        return None
+    return t.replace(tzinfo=timezone.utc).timestamp()
+
+class LineBuffer:
+
+    """Collects the bytes read from a connection and splits them into lines.
+    Partial lines are kept until the rest of them arrive."""
+
+    def __init__(self, maxlen=MAX_LINE):
+        """Creates a new, empty line buffer.
+            :maxlen: Longest line accepted, in bytes (default MAX_LINE)
+
+        """
+        self._buf = bytearray()
+        self._maxlen = maxlen
+        self._discarding = False
+
+    def feed(self, data):
+        """Adds newly read bytes to the buffer.
+            :data: Bytes received from the transport
+            :returns: A list of the complete lines now available, decoded and
+                stripped of their line endings.  Blank lines are skipped.
+
+        """
+        buf = self._buf
+        buf += data
+        end = buf.rfind(b"\n")
+        if end < 0:
+            if len(buf) > self._maxlen:
+                # Drop the oversized line up to its newline, whenever that is
+                del buf[:]
+                self._discarding = True
+            return []
+
+        chunk = bytes(buf[:end])
+        del buf[:end + 1]
+        lines = chunk.split(b"\n")
+        if self._discarding:
+            del lines[0]
+            self._discarding = False
+
+        out = []
+        for l in lines:
+            # Some IRC clients also send \r with newlines - HexChat does, mIRC
+            # does not (see #3)
+            l = l.rstrip(b"\r")
+            if l and len(l) <= self._maxlen:
+                out.append(l.decode("UTF-8", "replace"))
+        return out
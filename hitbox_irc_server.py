@@ -1,7 +1,9 @@
 # vim: sts=4:sw=4:et:tw=80:nosta
-import asyncio, config, json, logging
-import hitbox_get_user_token
-from hitbox_irc_socket import HitboxClient
+import asyncio, config, logging, sys, time
+import hitbox_get_user_token, hitbox_http, hitbox_logging, hitbox_metrics
+from hitbox_irc_parser import LineBuffer, format_server_time, format_tags
+from hitbox_irc_parser import parse_line, parse_server_time
+from hitbox_irc_socket import BudgetExceeded, FingerprintCache, HitboxClient
 
 class IRCServerProtocol(asyncio.Protocol):
 
@@ -10,17 +12,46 @@ class IRCServerProtocol(asyncio.Protocol):
     you may allow multiple clients to connect.  However, keep in mind that there
     is a limit to the number of connections allowed to Hitbox chat per IP."""
 
+    # Commands handled synchronously from data_received
+    _SYNC_COMMANDS = ("cap", "pass", "nick", "user")
+
+    # IRCv3 capabilities offered to clients
+    _CAPS = ("batch", "echo-message", "message-tags", "server-time")
+
+    # Capability needed for each outgoing tag; other tags need message-tags
+    _TAG_CAPS = {"batch": "batch", "time": "server-time"}
+
+    # Channel modes of the nick list roles (see handle_userList)
+    _ROLE_MODES = {"admin": "a", "mod": "o", "sub": "v", "reg": None}
+
     def __init__(self):
         """Creates a new IRC server."""
         asyncio.Protocol.__init__(self)
 
         self._log = logging.getLogger("irc")
+        self._traffic = logging.getLogger("irc.traffic")
         self._transport = None
         self._nick = None
         self._pass = None
         self._loggedin = False
+        self._loggingin = False
+        self._caps = set()
+        self._capnegotiating = False
+        self._batchid = 0
         self._logintoken = None
         self._channels = {}
+        self._joining = asyncio.Semaphore(config.joinConcurrency)
+        self._delivered = {} # channel -> FingerprintCache, kept across PARTs
+        self._linebuffer = LineBuffer()
+        self._outbuf = []
+        self._received = [] # receive times of the events in the output buffer
+        self._loop = asyncio.get_event_loop()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._slowtimer = None
+        self._slowdrops = {} # channel -> chat messages dropped while paused
+        self._historybatch = {} # channel -> batch of Hitbox's buffered chat
+        self._dispatch = self._get_dispatch_table()
 
     def connection_made(self, transport):
         """Called by Protocol whenever a new connection is made to the IRC
@@ -31,43 +62,161 @@ class IRCServerProtocol(asyncio.Protocol):
         peername = transport.get_extra_info("peername")
         self._log.info("Connection from {}".format(peername))
         self._transport = transport
+        hitbox_metrics.sessions.inc()
+        transport.set_write_buffer_limits(high=config.clientHighWater,
+            low=config.clientLowWater)
+
+    def connection_lost(self, exc):
+        """Called by Protocol when the connection to the client is closed.
+        Leaves all of the client's channels.
+            :exc: The exception that closed the connection, or None
+
+        """
+        self._log.info("Connection to {} lost".format(self._nick))
+        self._transport = None
+        hitbox_metrics.sessions.dec()
+        self._writable.set()
+        if self._slowtimer != None:
+            self._slowtimer.cancel()
+        asyncio.async(self.close_channels())
+
+    def pause_writing(self):
+        """Called by Protocol when the transport's write buffer is over the
+        high water mark because the client is not reading fast enough.  What
+        happens to chat in the meantime depends on config.slowClientPolicy:
+
+        wait - events are left in the channel queues, whose overflow policy
+            then applies
+        drop - chat messages are dropped until the client catches up
+        summarise - like drop, but the client is told how many messages each
+            channel lost once it catches up
+
+        If the client stays over the limit for config.slowClientTimeout
+        seconds, it is disconnected.
+
+        """
+        self._log.info("{} is reading too slowly, pausing".format(self._nick))
+        self._writable.clear()
+        if config.slowClientTimeout:
+            self._slowtimer = self._loop.call_later(config.slowClientTimeout,
+                self._slow_timeout)
+
+    def resume_writing(self):
+        """Called by Protocol once the transport's write buffer has drained
+        below the low water mark again."""
+        self._log.info("{} caught up, resuming".format(self._nick))
+        self._writable.set()
+        if self._slowtimer != None:
+            self._slowtimer.cancel()
+            self._slowtimer = None
+        for channel, count in self._slowdrops.items():
+            self.send("NOTICE #{} :{} messages were dropped because your "
+                "connection was too slow".format(channel, count))
+        self._slowdrops.clear()
+
+    def _slow_timeout(self):
+        """Disconnects a client that has not caught up in time."""
+        self._slowtimer = None
+        if self._transport != None:
+            self._log.warning("{} stayed too slow for {} seconds, "
+                "disconnecting".format(self._nick, config.slowClientTimeout))
+            self._outbuf = []
+            self._transport.abort()
 
     def data_received(self, data):
         """Called by Protocol whenever new data is available for the currrent
-        connection.  The purpose of this class is prety much to parse a command,
-        determine whether to call it synchronously or asynchronously, then call
-        the appropriate function.
+        connection.  Complete lines are split off the connection's line buffer
+        (partial lines are kept until the rest arrives), parsed, and handed to
+        dispatch().
             :data: The data received from the client
 
         """
-        msg = data.decode("UTF-8").split("\n")[:-1]
-        for line in msg:
-            # Some IRC clients also send \r with newlines - if this is the case,
-            # we need to remove it.  For HexChat, this is the case, for mIRC this
-            # is not the case.  (see #3)
-            line = line.strip() #some IRC clients also send \r - remove this
-            if line.split(" ")[0].strip().lower() != "pass":
-                self._log.info("<< {}".format(line))
+        for line in self._linebuffer.feed(data):
+            msg = parse_line(line)
+            if msg is None:
+                continue
+            if msg.command != "pass":
+                self._traffic.info("<< %s", line)
             else:
-                self._log.info("<< PASS ***")
-            tok = line.split(" ")
-            cmd = tok[0].strip().lower()
-            # We call the PASS, NICK, and USER commands synchronously to avoid
-            # having to lock and wait for subsequent commands to finish.  This
-            # also allows us to respond if, for instance, the PASS command was
-            # not sent when the NICK and USER commands have been.
-            if cmd in ["pass", "nick", "user"]: #Call these in sync
-                func = getattr(self, "on_{}".format(cmd), None)
-                if func != None:
-                    self._log.debug("Calling on_{} (synchronously)".format(cmd))
-                    func(tok[1:])
+                self._traffic.info("<< PASS ***")
+            self.dispatch(msg)
+
+    @classmethod
+    def _get_dispatch_table(cls):
+        """Builds the command dispatch table for this class the first time it
+        is needed.  The table maps each lowercased IRC command to its on_***
+        handler and whether that handler is called synchronously.
+            :returns: The dispatch table
+
+        """
+        table = cls.__dict__.get("_dispatch_table")
+        if table is None:
+            table = {}
+            for name in dir(cls):
+                if name.startswith("on_"):
+                    cmd = name[3:]
+                    table[cmd] = (getattr(cls, name), cmd in cls._SYNC_COMMANDS)
+            cls._dispatch_table = table
+        return table
+
+    def dispatch(self, msg):
+        """Calls the handler for a parsed IRC message.
+            :msg: The IRCMessage to handle
+
+        """
+        entry = self._dispatch.get(msg.command)
+        if entry is None:
+            self._log.debug("Unknown command %s(%s)", msg.command, msg.params)
+            return
+        func, sync = entry
+        # We call the PASS, NICK, and USER commands synchronously to avoid
+        # having to lock and wait for subsequent commands to finish.  This
+        # also allows us to respond if, for instance, the PASS command was
+        # not sent when the NICK and USER commands have been.
+        if sync:
+            self._log.debug("Calling on_%s (synchronously)", msg.command)
+            func(self, msg.params)
+        else:
+            self._log.debug("Calling on_%s", msg.command)
+            asyncio.async(func(self, msg.params))
+
+    def on_cap(self, tok):
+        """Called by data_received in response to a CAP command.  While
+        capabilities are being negotiated, registration waits for CAP END.
+            :tok: An array of tokens parsed from the command
+
+        """
+        if not tok:
+            return
+        sub = tok[0].upper()
+        nick = self._nick or "*"
+        if sub == "LS":
+            if not self._loggedin:
+                self._capnegotiating = True
+            self.send("CAP {} LS :{}".format(nick, " ".join(self._CAPS)))
+        elif sub == "LIST":
+            self.send("CAP {} LIST :{}".format(nick,
+                " ".join(sorted(self._caps))))
+        elif sub == "REQ":
+            if not self._loggedin:
+                self._capnegotiating = True
+            req = tok[1].split() if len(tok) > 1 else []
+            if all(c.lstrip("-") in self._CAPS for c in req):
+                for c in req:
+                    if c[0] == "-":
+                        self._caps.discard(c[1:])
+                    else:
+                        self._caps.add(c)
+                self.send("CAP {} ACK :{}".format(nick, " ".join(req)))
             else:
-                func = getattr(self, "on_{}".format(cmd), None)
-                if func != None:
-                    self._log.debug("Calling on_{}".format(cmd))
-                    asyncio.async(func(tok[1:]))
-                else:
-                    self._log.debug("Unknown command {}({})".format(cmd, tok[1:]))
+                self.send("CAP {} NAK :{}".format(nick, " ".join(req)))
+        elif sub == "END":
+            if self._capnegotiating:
+                self._capnegotiating = False
+                if self._loggedin:
+                    asyncio.async(self.welcome())
+        else:
+            self.send("410 {} {} :Invalid CAP command".format(nick, tok[0]))
 
     def on_pass(self, tok):
         """Called by data_received in response to a PASS command.
@@ -91,12 +240,13 @@ class IRCServerProtocol(asyncio.Protocol):
         input past the command but handles all of the registration logic.
             :tok: An array of tokens parsed from the command
         """
-        if self._loggedin == False:
+        if self._loggingin:
+            self._log.debug("USER while logging in, ignoring")
+        elif self._loggedin == False:
             if self._pass != None and self._nick != None:
                 self._log.debug("Logging in user {}".format(self._nick))
-                self._logintoken = hitbox_get_user_token \
-                    .obtain_token(self._nick, self._pass)
-                self.authenticate()
+                self._loggingin = True
+                asyncio.async(self.login())
             elif self._nick == None:
                 self._log.debug("USER before NICK, ignoring")
                 return
@@ -104,50 +254,136 @@ class IRCServerProtocol(asyncio.Protocol):
                 self._log.debug("USER before PASS, sending error")
                 text = "464 {} :No password given.  Closing connection" \
                     .format(self._nick)
-                asyncio.async(self.send(text))
+                self.send(text)
                 asyncio.async(self.disconnect())
         else:
             self._log.debug(
                 "User {} attempted reregistration".format(self._nick))
-            asyncio.async(
-                self.send("462 {} :You have already registered." \
-                .format(self._nick)))
+            self.send("462 {} :You have already registered." \
+                .format(self._nick))
+
+    @staticmethod
+    def channel_list(param):
+        """Splits the comma separated channel list of a JOIN or PART.
+            :param: The list, e.g. #a,#b
+            :returns: The lowercased channel names without #, in order and
+                without duplicates
+
+        """
+        channels = []
+        for c in param.split(","):
+            c = c.strip().lstrip("#").lower()
+            if c and c not in channels:
+                channels.append(c)
+        return channels
 
     @asyncio.coroutine
     def on_join(self, tok):
-        """Called by data_received in response to a JOIN command.  This command
-        handles the creation of a new Hitbox WS object, and sends it off to the
-        handle_socket function to handle incoming messages.
+        """Called by data_received in response to a JOIN command.  Every
+        channel in the comma separated list is joined at the same time, so
+        that a client rejoining many channels at once is not kept waiting for
+        each of them in turn.
             :tok: An array of tokens parsed from the command
         """
         if not self._loggedin:
             self._log.debug("JOIN before registration, ignoring")
-        else:
-            channel = tok[0].lstrip("#").lower()
-            if channel in self._channels:
-                self._log.debug("JOIN called but already in #{}"
-                    .format(channel))
+        elif tok:
+            # The channels are taken before anything else runs, so that a
+            # PART sent right after the JOIN finds them
+            joins = []
+            for channel in self.channel_list(tok[0]):
+                if self._channels.get(channel) != None:
+                    self._log.debug("JOIN called but already in #{}"
+                        .format(channel))
+                    continue
+                self._log.debug("Joining {}".format(channel))
+                client = HitboxClient(channel, self._nick, self._logintoken)
+                self._channels[channel] = client
+                # Started here, so that channels connect in list order
+                joins.append(asyncio.async(self.join(channel, client)))
+            yield from asyncio.gather(*joins)
+
+    @asyncio.coroutine
+    def join(self, channel, client):
+        """Joins a Hitbox channel and hands it off to the handle_socket
+        function to handle incoming messages.  At most config.joinConcurrency
+        channels of a session are connecting at a time; the JOIN is sent to
+        the client as soon as its channel is up.
+            :channel: The channel name, lowercased and without #
+            :client: The HitboxClient of the channel, already in
+                self._channels
+
+        """
+        yield from self._joining.acquire()
+        try:
+            if self._channels.get(channel) is not client:
+                # Parted or quit while waiting for our turn
+                yield from client.close_connection()
                 return
-            self._log.debug("Joining {}".format(channel))
-            self._channels[channel] = HitboxClient(channel, self._nick,
-            self._logintoken)
-            asyncio.async(self._channels[channel].connect())
-            yield from self.handle_socket(channel)
+            yield from client.connect(lambda position, wait:
+                self.send_queued(channel, position, wait))
+        except Exception as e:
+            if self._channels.get(channel) is not client:
+                return # parted or quit while waiting
+            del self._channels[channel]
+            if not isinstance(e, BudgetExceeded):
+                self._log.error("Could not connect to #{}: {!r}"
+                    .format(channel, e))
+                self.send("437 {} #{} :Channel is temporarily unavailable"
+                    .format(self._nick, channel))
+                return
+            self._log.warning("Could not join #{}: {}".format(channel, e))
+            self.send("{} {} #{} :{}{}".format(e.numeric, self._nick,
+                channel, e, self.wait_text(e.wait, ", try again in ")))
+            return
+        finally:
+            self._joining.release()
+        if self._channels.get(channel) is not client:
+            yield from client.close_connection()
+            return
+        yield from self.handle_socket(channel)
+
+    @staticmethod
+    def wait_text(wait, prefix):
+        """Formats an estimated wait for a message to the user.
+            :wait: Estimated seconds, or None if unknown
+            :prefix: Text to put in front of the estimate
+            :returns: The text, or an empty string if the wait is unknown
+
+        """
+        if wait == None:
+            return ""
+        return "{}about {} seconds".format(prefix, max(1, round(wait)))
+
+    def send_queued(self, channel, position, wait):
+        """Tells the user that a JOIN waits for a free Hitbox connection.
+            :channel: The channel being joined
+            :position: Position of the JOIN in line
+            :wait: Estimated seconds to wait, or None if unknown
+
+        """
+        self.send("NOTICE {} :Waiting for a free Hitbox connection to join "
+            "#{} (position {}{})".format(self._nick, channel, position,
+            self.wait_text(wait, ", ")))
 
     @asyncio.coroutine
     def on_part(self, tok):
         """Called by data_received in response to a PART command.  This command
-        handles the deletion of a specific Hitbox WS object.
+        handles the deletion of the Hitbox WS objects of the channels in the
+        comma separated list.
             :tok: An array of tokens parsed from the command
         """
-        if self._loggedin:
-            c = tok[0].lstrip("#").lower()
-            self._log.debug(tok[0])
-            self._log.debug(tok[0].lstrip("#").lower())
-            yield from self._channels[c].close_connection()
-            self._channels[c] = None
-            self._log.debug("Connection to #{} closed." \
-                .format(c))
+        if self._loggedin and tok:
+            for c in self.channel_list(tok[0]):
+                client = self._channels.get(c)
+                if client == None:
+                    self.send("442 {} #{} :You're not on that channel"
+                        .format(self._nick, c))
+                    continue
+                self._channels[c] = None
+                yield from client.close_connection()
+                self._log.debug("Connection to #{} closed." \
+                    .format(c))
 
     @asyncio.coroutine
     def on_names(self, tok):
@@ -158,9 +394,8 @@ class IRCServerProtocol(asyncio.Protocol):
         if self._loggedin:
             c = tok[0].lstrip("#").lower()
             self._log.debug("Retrieving nick list for {}".format(c))
-            #yield from self._channels[c].signalNames()
-            #yield from self._channels[c].userList()
-            #TODO: unstub this when i fix the updater implementation
+            if self._channels.get(c) != None:
+                yield from self._channels[c].names()
 
     @asyncio.coroutine
     def on_quit(self, tok):
@@ -169,14 +404,18 @@ class IRCServerProtocol(asyncio.Protocol):
             :tok: An array of tokens parsed from the command
         """
         if self._loggedin:
-            for k, c in self._channels.items():
-                try:
-                    yield from c.close_connection()
-                    self._channels[k] = None
-                    self._log.debug("Connection to #{} closed." \
-                        .format(k))
-                except AttributeError:
-                    self._log.debug("All connections closed due to disconnect.")
+            yield from self.close_channels()
+
+    @asyncio.coroutine
+    def close_channels(self):
+        """Closes the Hitbox WS objects of all joined channels."""
+        for k, c in list(self._channels.items()):
+            if c != None:
+                self._channels[k] = None
+                yield from c.close_connection()
+                self._log.debug("Connection to #{} closed." \
+                    .format(k))
+        self._log.debug("All connections closed due to disconnect.")
 
     @asyncio.coroutine
     def on_privmsg(self, tok):
@@ -185,155 +424,493 @@ class IRCServerProtocol(asyncio.Protocol):
             :tok: An array of tokens parsed from the command
         """
         if self._loggedin:
-            if tok[0][0] == "#":
+            if len(tok) > 1 and tok[0][0] == "#":
                 c = tok[0].lstrip("#").lower()
-                t = " ".join(tok[1:])[1:]
+                t = tok[1]
                 yield from self._channels[c].sendMessage(t)
+                if "echo-message" in self._caps:
+                    self.sendn("PRIVMSG #{} :{}".format(c, t),
+                        tags={"time": format_server_time(time.time())})
+
+    @asyncio.coroutine
+    def on_chathistory(self, tok):
+        """Called by data_received in response to a CHATHISTORY command.
+        Sends the messages remembered for a joined channel.  Only the LATEST,
+        BEFORE and AFTER subcommands are supported, with timestamps.
+            :tok: An array of tokens parsed from the command
+        """
+        if not self._loggedin:
+            return
+        if len(tok) < 4:
+            self.send("FAIL CHATHISTORY NEED_MORE_PARAMS :Missing parameters")
+            return
+        kind = tok[0].lower()
+        if kind not in ("latest", "before", "after"):
+            self.send("FAIL CHATHISTORY INVALID_PARAMS {} :Unsupported "
+                "subcommand".format(tok[0]))
+            return
+        c = tok[1].lstrip("#").lower()
+        client = self._channels.get(c)
+        if client == None or client._subscription == None:
+            self.send("FAIL CHATHISTORY INVALID_TARGET {} {} :Not in channel"
+                .format(tok[0], tok[1]))
+            return
+        t = None
+        if tok[2] != "*" or kind != "latest":
+            key, _, value = tok[2].partition("=")
+            t = parse_server_time(value) if key == "timestamp" else None
+            if t == None:
+                self.send("FAIL CHATHISTORY INVALID_PARAMS {} :Only "
+                    "timestamps are supported".format(tok[2]))
+                return
+        try:
+            limit = int(tok[3])
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            self.send("FAIL CHATHISTORY INVALID_PARAMS {} :Invalid limit"
+                .format(tok[3]))
+            return
+        self.send_history(c, client._subscription.history.query(kind, t,
+            limit))
+
+    @asyncio.coroutine
+    def on_stats(self, tok):
+        """Called by data_received in response to a STATS command.  Replies
+        with the proxy's metrics, one per line.
+            :tok: An array of tokens parsed from the command
+        """
+        if self._loggedin:
+            query = tok[0] if tok else "*"
+            for line in hitbox_metrics.registry.summary():
+                self.send("249 {} :{}".format(self._nick, line))
+            self.send("219 {} {} :End of /STATS report"
+                .format(self._nick, query))
 
     @asyncio.coroutine
     def handle_socket(self, channel):
         """This command handles incoming messages from the Hitbox WS object.
-        When the user parts the channel, the client object is set to None,
-        so the while loop can break out.  Individual messages are handed off to
+        When the user parts the channel, the client's queue is closed, so the
+        while loop can break out.  Individual messages are handed off to
         a handle_*** command.
             :channel: Channel name to handle incoming messages for
         """
         self._log.debug("Socket handler for {} established." \
             .format(channel))
-        while self._channels[channel] != None:
-            msg = yield from self._channels[channel].getNextMessage()
-            self._log.debug("incoming message from {}: {}" \
-                .format(channel, msg))
-            j = json.loads(msg)
-            #yes, this code is correct
-            cmd = json.loads(j["args"][0])["method"]
-            func = getattr(self, "handle_{}".format(cmd), None)
+        client = self._channels.get(channel)
+        if client == None:
+            return
+        policy = config.slowClientPolicy
+        while self._channels.get(channel) is client:
+            if policy == "wait" and not self._writable.is_set():
+                self.end_history_batch(channel)
+                yield from self._writable.wait()
+                continue
+            if not len(client._waitingmessages):
+                self.end_history_batch(channel)
+            event = yield from client.getNextMessage()
+            if event == None:
+                self.end_history_batch(channel)
+                if client._lost:
+                    yield from self.lost_channel(channel)
+                break
+            if event.method == "chatMsg" and not self._writable.is_set():
+                if policy == "summarise":
+                    self._slowdrops[channel] = \
+                        self._slowdrops.get(channel, 0) + 1
+                continue
+            if not (event.method == "chatMsg" and event.buffer):
+                self.end_history_batch(channel)
+            self._log.debug("incoming message from %s: %s", channel, event)
+            func = getattr(self, "handle_{}".format(event.method), None)
             if func != None:
-                self._log.debug("Calling on_{}".format(cmd))
-                asyncio.async(func(json.loads(j["args"][0])))
+                self._log.debug("Calling handle_%s", event.method)
+                yield from func(event)
+                if event.received != None and self._outbuf:
+                    self._received.append(event.received)
             else:
-                self._log.warning("Unknown HB command {}({})".format(cmd, j))
+                self._log.warning("Unknown HB command {}({})"
+                    .format(event.method, event.params))
+
+    @asyncio.coroutine
+    def lost_channel(self, channel):
+        """Parts the client from a channel whose Hitbox connection could not
+        be reestablished, so that it may simply join again later.
+            :channel: Channel name
+        """
+        client = self._channels.get(channel)
+        if client == None:
+            return
+        self._channels[channel] = None
+        self.sendn("PART #{} :Lost connection to Hitbox".format(channel))
+        yield from client.close_connection()
+
+    def start_batch(self, kind, *params):
+        """Opens an IRCv3 batch, if the client supports them.
+            :kind: Batch type
+            :params: Parameters of the batch type
+            :returns: The batch reference to tag lines with, or None
+
+        """
+        if "batch" not in self._caps:
+            return None
+        self._batchid += 1
+        ref = "hb{}".format(self._batchid)
+        self.send(" ".join(("BATCH", "+" + ref, kind) + params))
+        return ref
+
+    def end_batch(self, ref):
+        """Closes a batch opened by start_batch()."""
+        if ref != None:
+            self.send("BATCH -{}".format(ref))
+
+    def history_batch(self, channel):
+        """Returns the chathistory batch that Hitbox's buffered chat of a
+        channel is sent in, opening it with the first buffered message.  It
+        is closed by end_history_batch() once live events follow or the
+        channel's queue is drained.
+            :channel: Channel name, without the #
+            :returns: The batch reference, or None
+
+        """
+        if channel not in self._historybatch:
+            self._historybatch[channel] = self.start_batch("chathistory",
+                "#" + channel)
+        return self._historybatch[channel]
+
+    def end_history_batch(self, channel):
+        """Closes the batch opened by history_batch(), if any.
+            :channel: Channel name, without the #
+
+        """
+        if channel in self._historybatch:
+            self.end_batch(self._historybatch.pop(channel))
+
+    def send_history(self, channel, entries):
+        """Sends chat history as one chathistory batch, each message with its
+        original time.
+            :channel: Channel name, without the #
+            :entries: List of (time, nick, text) tuples, oldest first
+
+        """
+        ref = self.start_batch("chathistory", "#" + channel)
+        for t, name, text in entries:
+            self.sendn("PRIVMSG #{} :{}".format(channel, text), nick=name,
+                tags={"time": format_server_time(t), "batch": ref})
+        self.end_batch(ref)
+
+    def seen(self, channel, t, name, text):
+        """Records a chat message sent to the client, and tells whether the
+        client was sent it before, possibly before it last left the channel.
+            :channel: Channel name, without the #
+            :t: The message's Hitbox time
+            :name: Nick of the sender
+            :text: The message
+            :returns: True if the message was sent before
+
+        """
+        cache = self._delivered.get(channel)
+        if cache == None:
+            cache = self._delivered[channel] = FingerprintCache()
+        return cache.seen(t, name, text)
+
+    @asyncio.coroutine
+    def handle_chatHistory(self, event):
+        """This command handles the chat history replayed by the proxy when
+        a channel is joined.  Messages the client was already sent, e.g.
+        before it last left the channel, are left out.
+            :event: The decoded HitboxEvent
+        """
+        c = event.channel
+        entries = [e for e in event.params["entries"]
+            if not self.seen(c, *e)]
+        if entries:
+            self.send_history(c, entries)
 
     @asyncio.coroutine
-    def handle_loginMsg(self, json):
+    def handle_loginMsg(self, event):
         """This command handles incoming join messages.  This is sent by the
-        server in response to a JOIN command issued by the client.
-            :json: Parsed JSON.
+        server in response to a JOIN command issued by the client.  Hitbox
+        joins us as a guest if it no longer accepts our login token; the
+        token is then dropped from the cache, so that the next session of
+        the account logs in again.
+            :event: The decoded HitboxEvent
         """
-        yield from self.sendn("JOIN :#{}".format(json["params"]["channel"]))
+        self.sendn("JOIN :#{}".format(event.channel))
+        if event.params.get("role") == "guest":
+            self._log.warning("Hitbox rejected the login token of {}"
+                .format(self._nick))
+            hitbox_get_user_token.tokens.invalidate(self._nick, self._pass)
+            self.send("NOTICE #{} :Hitbox did not accept your login, you "
+                "cannot chat here.  Reconnect to log in again"
+                .format(event.channel))
 
     @asyncio.coroutine
-    def handle_chatMsg(self, json):
+    def handle_chatMsg(self, event):
         """This command handles incoming chat messages.  This is sent by the
         server either because of buffered text on a JOIN, or because someone
-        actually sent a message.  If it was due to the first,
-        json["params"]["buffer"] will be set to true.
-            :json: Parsed JSON.
+        actually sent a message.  If it was due to the first, event.buffer
+        will be set to true, and the message is dropped if the client was
+        already sent it; otherwise it is sent in the channel's chathistory
+        batch (see history_batch()).
+            :event: The decoded HitboxEvent
         """
-        if json["params"]["name"] != self._nick:
-            yield from self.sendn("PRIVMSG #{} :{}" \
-                .format(json["params"]["channel"], json["params"]["text"]),
-                nick=json["params"]["name"])
+        if event.name != self._nick:
+            if self.seen(event.channel, event.time, event.name, event.text) \
+                and event.buffer:
+                return
+            tags = {}
+            if isinstance(event.time, (int, float)):
+                tags["time"] = format_server_time(event.time)
+            if event.buffer:
+                tags["batch"] = self.history_batch(event.channel)
+            self.sendn("PRIVMSG #{} :{}" \
+                .format(event.channel, event.text), nick=event.name,
+                tags=tags)
+
+    @asyncio.coroutine
+    def handle_slowMsg(self, event):
+        """This command handles slow mode changes of a channel.
+            :event: The decoded HitboxEvent
+        """
+        slow = event.params.get("slowTime", event.params.get("time"))
+        if slow:
+            self.send("NOTICE #{} :Slow mode is on, one message every {} "
+                "seconds".format(event.channel, slow))
+        else:
+            self.send("NOTICE #{} :Slow mode is off".format(event.channel))
 
     @asyncio.coroutine
-    def handle_userList(self, json):
+    def handle_sendDropped(self, event):
+        """This command handles messages from the client that could not be
+        sent to the channel.
+            :event: The decoded HitboxEvent
+        """
+        self.send("NOTICE #{} :{} message(s) not sent: {}".format(
+            event.channel, event.params["count"], event.params["reason"]))
+
+    @asyncio.coroutine
+    def handle_userList(self, event):
         """This command handles incoming userlist messages.  This is sent by
         the server if a NAMES request happened.
-            :json: Parsed JSON.
+            :event: The decoded HitboxEvent
         """
-        @asyncio.coroutine
-        def iterate_list(nicklist, modechar):
-            for l in nicklist:
-                yield from self.send("353 {} = #{} :{}{}".format(
-                    self._nick,
-                    json["params"]["channel"],
-                    modechar,
-                    l))
-
+        data = event.params["data"]
         self._log.debug("Calculating NAMES result...")
-        ownerlist = list(set(json["params"]["data"]["admin"])
-            .intersection([self._nick]))
-        adminlist = list(set(json["params"]["data"]["admin"]) - set(ownerlist))
-        modlist = json["params"]["data"]["user"]
-        fullsublist = json["params"]["data"]["isSubscriber"]
-        sublist = list(set(fullsublist) - set(adminlist) - set(modlist))
-        fullreglist = json["params"]["data"]["anon"]
-        reglist = list(set(fullreglist) - set(fullsublist))
-        for l in [adminlist, modlist, sublist, reglist]:
-            self._log.debug(repr(l))
-        for l in [[ownerlist, "~"], [adminlist, "&"], [modlist, "@"],
-            [sublist, "+"], [reglist, ""]]:
-            yield from iterate_list(l[0], l[1])
+        admins = set(data["admin"])
+        ownerlist = admins.intersection([self._nick])
+        adminlist = admins - ownerlist
+        modlist = set(data["user"]) - admins
+        fullsublist = set(data["isSubscriber"])
+        sublist = fullsublist - admins - modlist
+        reglist = set(data["anon"]) - fullsublist - admins - modlist
+        names = []
+        for l, modechar in [[ownerlist, "~"], [adminlist, "&"],
+            [modlist, "@"], [sublist, "+"], [reglist, ""]]:
+            names.extend(modechar + nick for nick in l)
+        self.send_names(event.channel, names)
+
+    def send_names(self, channel, names):
+        """Queues a complete NAMES reply.  As many names as fit are packed
+        into each 353 line without exceeding the 512 byte line limit, and the
+        reply is ended with a 366.  Clients supporting batches get the reply
+        as one hitbox.tv/names batch.
+            :channel: Channel name, without the #
+            :names: List of nicks, each with its prefix character
+
+        """
+        ref = self.start_batch("hitbox.tv/names", "#" + channel)
+        tags = self._tag_prefix({"batch": ref})
+        head = ":hitbox_irc_proxy 353 {} = #{} :".format(self._nick, channel)
+        room = 510 - len(head.encode("UTF-8")) # 512 bytes minus CRLF
+        lines = []
+        line = []
+        size = 0
+        for name in names:
+            n = len(name.encode("UTF-8"))
+            if line and size + 1 + n > room:
+                lines.append(tags + head + " ".join(line) + "\n")
+                line = []
+                size = 0
+            size += n + (1 if line else 0)
+            line.append(name)
+        if line:
+            lines.append(tags + head + " ".join(line) + "\n")
+        lines.append(tags + ":hitbox_irc_proxy 366 {} #{} :End of /NAMES "
+            "list.\n".format(self._nick, channel))
+        self._traffic.info(">> NAMES #%s: %d names in %d lines", channel,
+            len(names), len(lines) - 1)
+        self._write(*lines)
+        self.end_batch(ref)
+
+    @asyncio.coroutine
+    def login(self):
+        """Obtains a login token for the registered nick and password without
+        blocking the event loop, then checks the result.  Tokens are shared
+        with other sessions of the same account through the token cache."""
+        try:
+            self._logintoken = yield from hitbox_get_user_token.tokens \
+                .get(self._nick, self._pass)
+        except Exception as e:
+            self._log.error("Login request for {} failed: {!r}"
+                .format(self._nick, e))
+            self._logintoken = None
+        self._loggingin = False
+        self.authenticate()
+
+    def _role_mode(self, nick, role):
+        """Returns the channel mode letter for a nick list role, or None for
+        regular users.  An admin is shown as the owner to themselves."""
+        if role == "admin" and nick == self._nick:
+            return "q"
+        return self._ROLE_MODES[role]
+
+    @asyncio.coroutine
+    def handle_userDelta(self, event):
+        """This command handles changes to a channel's nick list since the
+        last userList, and sends them as JOIN, PART and MODE messages.
+            :event: The decoded HitboxEvent
+        """
+        c = event.channel
+        for nick, role in event.params["joined"]:
+            if nick == self._nick:
+                continue
+            self.sendn("JOIN :#{}".format(c), nick=nick)
+            mode = self._role_mode(nick, role)
+            if mode != None:
+                self.send("MODE #{} +{} {}".format(c, mode, nick))
+        for nick in event.params["parted"]:
+            if nick != self._nick:
+                self.sendn("PART #{}".format(c), nick=nick)
+        for nick, oldrole, newrole in event.params["changed"]:
+            modes = ""
+            args = []
+            for sign, mode in (("-", self._role_mode(nick, oldrole)),
+                ("+", self._role_mode(nick, newrole))):
+                if mode != None:
+                    modes += sign + mode
+                    args.append(nick)
+            if modes:
+                self.send("MODE #{} {} {}"
+                    .format(c, modes, " ".join(args)))
 
     def authenticate(self):
         """Check the authentication result.  If OK, send the welcome message.
         If it fails, disconnect the user."""
         if self._logintoken == None:
+            hitbox_get_user_token.tokens.invalidate(self._nick, self._pass)
             text = ("464 {} :Invalid password given.  Closing connection") \
                 .format(self._nick)
-            asyncio.async(self.send(text))
+            self.send(text)
             asyncio.async(self.disconnect())
         else:
             self._loggedin = True
-            asyncio.async(self.welcome())
+            if not self._capnegotiating:
+                asyncio.async(self.welcome())
 
     @asyncio.coroutine
     def welcome(self):
         """Called after a successful registration to alert the clent that they
         have been logged in."""
-        yield from self.send(
+        self.send(
             ("001 {} :Welcome to the IRC Relay Network {}! {}@hitbox_irc_proxy")
             .format(self._nick, self._nick, self._nick))
-        yield from self.send(
+        self.send(
             ("002 {} :Your host is hitbox_irc_proxy, running v2.0")
             .format(self._nick))
-        yield from self.send(
+        self.send(
             ("003 {} :This server was created 5/6 3:40 PM")
             .format(self._nick))
-        yield from self.send(
-            ("005 {} PREFIX=(qaohv)~&@%+ CHANMODES=fm " +
+        self.send(
+            ("005 {} PREFIX=(qaohv)~&@%+ CHANMODES=fm CHATHISTORY={} " +
             ":are supported by this server")
-            .format(self._nick))
+            .format(self._nick, config.historySize))
 
-    @asyncio.coroutine
-    def send(self, data):
-        """Sends the data to the client after prepending the server ID."""
-        b = (":hitbox_irc_proxy " + data + "\n").encode("UTF-8")
-        self._log.info(">> {}".format(b.decode("UTF-8").strip()))
-        self._transport.write(b)
+    def _tag_prefix(self, tags):
+        """Builds the tag section for an outgoing line, leaving out the tags
+        whose capability the client did not enable.
+            :tags: Dictionary of tag names to values, or None
+            :returns: The tag section with its @ and trailing space, or an
+                empty string
 
-    @asyncio.coroutine
-    def sendn(self, data, nick=None):
-        """Sends the data to the client after prepending the nick info."""
+        """
+        if not tags or not self._caps:
+            return ""
+        caps = self._caps
+        allowed = {k: v for k, v in tags.items() if v != None and
+            self._TAG_CAPS.get(k, "message-tags") in caps}
+        if not allowed:
+            return ""
+        return "@" + format_tags(allowed) + " "
+
+    def send(self, data, tags=None):
+        """Sends the data to the client after prepending the server ID.
+            :data: The line, without prefix or line ending
+            :tags: Dictionary of IRCv3 tags to send with it (default None)
+
+        """
+        self._traffic.info(">> :hitbox_irc_proxy %s", data)
+        self._write(self._tag_prefix(tags), ":hitbox_irc_proxy ", data, "\n")
+
+    def sendn(self, data, nick=None, tags=None):
+        """Sends the data to the client after prepending the nick info.
+            :data: The line, without prefix or line ending
+            :nick: Nick the line is from (default the client's own)
+            :tags: Dictionary of IRCv3 tags to send with it (default None)
+
+        """
         if nick == None:
             nick = self._nick
-        b = (":{}!{}@hitbox_irc_proxy " \
-            .format(nick, nick) + data + "\n").encode("UTF-8")
-        self._log.info(">> {}".format(b.decode("UTF-8").strip()))
-        self._transport.write(b)
+        self._traffic.info(">> :%s!%s@hitbox_irc_proxy %s", nick, nick, data)
+        self._write(self._tag_prefix(tags), ":", nick, "!", nick,
+            "@hitbox_irc_proxy ", data, "\n")
+
+    def _write(self, *parts):
+        """Adds text to the output buffer.  Everything written during one
+        iteration of the event loop is sent to the client in a single write.
+            :parts: Strings making up one or more complete lines
+
+        """
+        if not self._outbuf:
+            self._loop.call_soon(self._flush)
+        self._outbuf.extend(parts)
+
+    def _flush(self):
+        """Writes the output buffer to the transport, and records how long
+        the events written had been waiting since they were received."""
+        if self._outbuf:
+            if self._transport != None:
+                self._transport.write("".join(self._outbuf).encode("UTF-8"))
+                now = self._loop.time()
+                for t in self._received:
+                    hitbox_metrics.delivery_latency.observe(now - t)
+            del self._outbuf[:]
+            del self._received[:]
 
     @asyncio.coroutine
     def disconnect(self):
         """Disconnects the client gracefully."""
+        self._flush()
         self._transport.close()
 
 if __name__ == "__main__":
-    logs = [logging.getLogger(x) for x in ["irc", "asyncio", "main", "token",
-    "ws"]]
-    ch = logging.StreamHandler()
-    ch.setLevel(config.logLevel)
-    formatter = logging.Formatter(config.logFormat)
-    ch.setFormatter(formatter)
-    for x in logs:
-        x.setLevel(config.logLevel)
-        x.addHandler(ch)
+    if config.workers != 1:
+        # Only imported here, as it needs the Unix-only fcntl module
+        import hitbox_workers
+        hitbox_logging.setup(["asyncio", "main"])
+        hitbox_workers.Supervisor().run()
+        sys.exit()
+    hitbox_logging.setup(["irc", "asyncio", "main", "token", "ws", "http"])
 
     loop = asyncio.get_event_loop()
-    coro = loop.create_server(IRCServerProtocol, port=7778)
+    coro = loop.create_server(IRCServerProtocol, port=config.ircPort)
     server = loop.run_until_complete(coro)
     thislog = logging.getLogger("main")
     thislog.info("Serving requests on {}" \
         .format(server.sockets[0].getsockname()))
+    metrics = None
+    if config.metricsPort:
+        metrics = loop.run_until_complete(hitbox_metrics.serve())
     try:
         loop.run_forever()
     except KeyboardInterrupt as e:
@@ -341,4 +918,8 @@ if __name__ == "__main__":
     finally:
         server.close()
         loop.run_until_complete(server.wait_closed())
+        if metrics != None:
+            metrics.close()
+            loop.run_until_complete(metrics.wait_closed())
+        loop.run_until_complete(hitbox_http.close())
         loop.close()
@@ -1,56 +1,402 @@
 # vim: sts=4:sw=4:et:tw=80:nosta
-import asyncio, aiohttp, config, json, logging, random, websockets
-from datetime import datetime
+import asyncio, config, heapq, hitbox_frames, hitbox_http, hitbox_metrics
+import json, logging, random, time, weakref, websockets
+from collections import OrderedDict, deque
+
+# Incoming frames are decoded with the fastest JSON library available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        json_loads = json.loads
+
+class HitboxEvent:
+
+    """A message received from Hitbox chat, decoded once from its socket.io
+    frame.  The fields every handler needs are pulled out of the parameters;
+    the parameters themselves are kept in params.  time is the Unix time
+    Hitbox gives for chat messages, and received is the event loop time the
+    frame arrived at, if it came from the websocket."""
+
+    __slots__ = ("method", "channel", "name", "text", "buffer", "time",
+        "params", "received")
+
+    def __init__(self, method, params):
+        """Creates a new event.
+            :method: The Hitbox method, e.g. chatMsg
+            :params: Dictionary of the message parameters
 
-class HitboxClient:
+        """
+        self.method = method
+        self.params = params
+        self.channel = params.get("channel")
+        self.name = params.get("name")
+        self.text = params.get("text")
+        self.buffer = bool(params.get("buffer", False))
+        self.time = params.get("time")
+        self.received = None
+
+    def __repr__(self):
+        return "HitboxEvent({!r}, {!r})".format(self.method, self.params)
+
+def decode_frame(data):
+    """Decodes the payload of a socket.io message frame.  Hitbox sends the
+    message itself as a JSON encoded string inside the JSON frame, so both
+    layers are decoded here, exactly once.
+        :data: The frame with its 5::: prefix removed
+        :returns: A HitboxEvent, or None if the frame is not a chat message
+
+    """
+    try:
+        args = json_loads(data)["args"][0]
+        if isinstance(args, str):
+            args = json_loads(args)
+        return HitboxEvent(args["method"], args.get("params") or {})
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+class EventQueue:
+
+    """Bounded queue of the HitboxEvents waiting to be handled by the IRC
+    side.  When the queue is full, the overflow policy decides what happens to
+    a new event:
+
+    drop - the oldest buffered history event is dropped, or the oldest event
+        if no history is queued (nick list changes are dropped last)
+    coalesce - a userList snapshot replaces the one already queued (a newer
+        snapshot makes it useless); other events are dropped as above
+    pause - the caller of put() waits until there is room again.  This stops
+        reading from the websocket, so Hitbox may disconnect us if the IRC
+        side stays stuck long enough to miss pings.  offer() never waits,
+        and drops instead
+
+    """
+
+    POLICIES = ("drop", "coalesce", "pause")
+
+    # Queues still in use, for the queued events metric
+    live = weakref.WeakSet()
+
+    def __init__(self, maxsize=None, policy=None):
+        """Creates a new, empty queue.
+            :maxsize: Maximum number of queued events (default
+                config.eventQueueSize)
+            :policy: Overflow policy, one of POLICIES (default
+                config.eventQueuePolicy)
 
-    """Handles connections to Hitbox WS Chat."""
+        """
+        self._maxsize = config.eventQueueSize if maxsize == None else maxsize
+        self._policy = config.eventQueuePolicy if policy == None else policy
+        if self._policy not in self.POLICIES:
+            raise ValueError("Unknown overflow policy {}".format(self._policy))
+        self._events = deque()
+        self._buffered = 0 # number of queued buffered history events
+        self._notempty = asyncio.Event()
+        self._notfull = asyncio.Event()
+        self._notfull.set()
+        self._closed = False
+        self.maxdepth = 0 # most events ever queued at once
+        EventQueue.live.add(self)
+
+    def __len__(self):
+        return len(self._events)
+
+    def close(self):
+        """Closes the queue.  Events put afterwards are discarded, and get()
+        returns None once the remaining events have been read."""
+        self._closed = True
+        self._notempty.set()
+        self._notfull.set()
 
-    def __init__(self, channel, nick=None, logintoken=None):
-        """Creates a new Hitbox Client.
-            :nick: The user's Hitbox nickname (default None)
+    @asyncio.coroutine
+    def get(self):
+        """Removes and returns the oldest event.  Blocks if the queue is
+        empty.
+            :returns: A HitboxEvent, or None if the queue was closed
+
+        """
+        while not self._events:
+            if self._closed:
+                return None
+            self._notempty.clear()
+            yield from self._notempty.wait()
+        event = self._events.popleft()
+        if event.buffer:
+            self._buffered -= 1
+        self._notfull.set()
+        return event
+
+    @asyncio.coroutine
+    def put(self, event):
+        """Adds an event to the queue, applying the overflow policy if the
+        queue is full.
+            :event: The HitboxEvent to add
+
+        """
+        events = self._events
+        if self._policy == "pause" and len(events) >= self._maxsize and \
+            not self._closed:
+            hitbox_metrics.events_paused.inc()
+            while len(events) >= self._maxsize and not self._closed:
+                self._notfull.clear()
+                yield from self._notfull.wait()
+        self.offer(event)
+
+    def offer(self, event):
+        """Adds an event to the queue without waiting.  If the queue is full,
+        the overflow policy applies, except that "pause" drops like "drop".
+            :event: The HitboxEvent to add
+
+        """
+        events = self._events
+        if self._closed:
+            return
+        if len(events) >= self._maxsize:
+            if self._policy == "coalesce" and event.method == "userList" \
+                and self._coalesce(event):
+                return
+            elif not self._drop(event):
+                return
+
+        events.append(event)
+        if event.buffer:
+            self._buffered += 1
+        if len(events) > self.maxdepth:
+            self.maxdepth = len(events)
+        self._notempty.set()
+
+    def _coalesce(self, event):
+        """Replaces the newest queued userList snapshot with the given one.
+            :returns: True if a snapshot was replaced
+
+        """
+        events = self._events
+        for i in range(len(events) - 1, -1, -1):
+            if events[i].method == "userList":
+                events[i] = event
+                hitbox_metrics.events_coalesced.inc()
+                return True
+        return False
+
+    def _drop(self, event):
+        """Makes room for a new event, dropping the oldest buffered history
+        first.
+            :event: The event about to be added
+            :returns: False if the new event itself was dropped instead
+
+        """
+        hitbox_metrics.events_dropped.inc()
+        events = self._events
+        if self._buffered:
+            for i, e in enumerate(events):
+                if e.buffer:
+                    del events[i]
+                    self._buffered -= 1
+                    return True
+        if event.buffer:
+            return False
+        # Nick list changes are kept if at all possible, as the IRC side would
+        # get out of sync without them
+        for i, e in enumerate(events):
+            if e.method != "userDelta":
+                del events[i]
+                return True
+        events.popleft()
+        return True
+
+hitbox_metrics.registry.add(hitbox_metrics.Gauge("hitbox_queued_events",
+    "Events waiting in channel queues",
+    lambda: sum(len(q) for q in EventQueue.live)))
+hitbox_metrics.registry.add(hitbox_metrics.Gauge("hitbox_queued_events_max",
+    "Most events ever waiting in one of the current channel queues",
+    lambda: max((q.maxdepth for q in EventQueue.live), default=0)))
+
+class ServerDirectory:
+
+    """Process-wide cache of the Hitbox chat server list.  The list is fetched
+    once and reused by every HitboxClient; once it is older than its TTL the
+    stale copy keeps being served while a single background request refreshes
+    it.  The directory also keeps the measured handshake round trip time and
+    error count of each server, so that clients prefer the fastest healthy
+    servers."""
+
+    def __init__(self, ttl=None):
+        """Creates a new, empty server directory.
+            :ttl: Seconds before the list is refreshed (default
+                config.serverListTTL)
+
+        """
+        self._ttl = config.serverListTTL if ttl == None else ttl
+        self._servers = None
+        self._fetched = 0
+        self._refreshing = None
+        self._stats = {} # server_ip -> [rtt, error count, last error time]
+        self._log = logging.getLogger("ws")
+
+    @asyncio.coroutine
+    def fetch(self):
+        """Obtain the WS server list from Hitbox.
+            :returns: The array of available servers.
+
+        """
+
+        d = yield from hitbox_http.request("GET",
+            "{}/chat/servers".format(config.API_URL))
+
+        j = json.loads(d.decode())
+        if not j:
+            raise IOError("Empty server list")
+        return j
+
+    @asyncio.coroutine
+    def get_servers(self):
+        """Returns the cached server list, fetching it if there is none yet.
+        Concurrent callers share a single request.
+            :returns: The array of available servers.
 
         """
+        if self._servers == None:
+            return (yield from asyncio.shield(self._refresh()))
+        if asyncio.get_event_loop().time() - self._fetched > self._ttl:
+            self._refresh()
+        return self._servers
+
+    def _refresh(self):
+        """Starts a refresh of the server list unless one is already running.
+            :returns: A future resolving to the new list
 
+        """
+        if self._refreshing == None:
+            self._log.debug("Refreshing chat server list")
+            self._refreshing = asyncio.async(self.fetch())
+            self._refreshing.add_done_callback(self._refreshed)
+        return self._refreshing
+
+    def _refreshed(self, fut):
+        """Stores the result of a server list refresh.  On failure the stale
+        list (if any) is kept."""
+        self._refreshing = None
+        if fut.cancelled():
+            return
+        if fut.exception() != None:
+            self._log.warning("Could not refresh chat server list: {!r}"
+                .format(fut.exception()))
+            return
+        self._servers = fut.result()
+        self._fetched = asyncio.get_event_loop().time()
+
+    def _healthy(self, server, now):
+        """Whether a server has had no errors within the error penalty."""
+        st = self._stats.get(server)
+        return st == None or st[1] == 0 or \
+            now - st[2] > config.serverErrorPenalty
+
+    def select(self, list):
+        """Picks a server to connect to.  Healthy servers are ranked by their
+        measured round trip time, servers without a measurement first so they
+        get one, and one of the best few is picked at random to spread load.
+            :list: List of servers to select from
+            :returns: A string containing a Hitbox WS server.
+
+        """
+        now = asyncio.get_event_loop().time()
+        ips = [s["server_ip"] for s in list]
+        candidates = [ip for ip in ips if self._healthy(ip, now)]
+        if not candidates:
+            # Everything failed recently, so retry the least broken ones
+            fewest = min(self._stats[ip][1] for ip in ips)
+            candidates = [ip for ip in ips if self._stats[ip][1] == fewest]
+
+        def rtt(ip):
+            st = self._stats.get(ip)
+            return 0 if st == None or st[0] == None else st[0]
+        candidates.sort(key=rtt)
+        return random.choice(candidates[:config.serverChoices])
+
+    def report_rtt(self, server, rtt):
+        """Records a successful handshake with a server.
+            :server: The server_ip that was contacted
+            :rtt: Seconds the handshake took
+
+        """
+        st = self._stats.setdefault(server, [None, 0, 0])
+        st[0] = rtt if st[0] == None else st[0] * 0.7 + rtt * 0.3
+        st[1] = 0
+
+    def report_error(self, server):
+        """Records a failed handshake or connection to a server.
+            :server: The server_ip that was contacted
+
+        """
+        st = self._stats.setdefault(server, [None, 0, 0])
+        st[1] += 1
+        st[2] = asyncio.get_event_loop().time()
+        self._log.debug("Server {} failed ({} errors)".format(server, st[1]))
+
+servers = ServerDirectory()
+
+class HitboxConnection:
+
+    """A websocket connection to a Hitbox chat server.  One connection carries
+    several channels of the same account; incoming messages are routed to the
+    HitboxClient of their channel.  Connections are created and shared by the
+    ConnectionManager.  If the websocket drops while channels are still in
+    use, the connection reconnects on its own (see reconnect())."""
+
+    def __init__(self, manager, key, nick=None, logintoken=None):
+        """Creates a new, unconnected Hitbox connection.
+            :manager: The ConnectionManager owning this connection
+            :key: The account key this connection is stored under
+            :nick: The user's Hitbox nickname (default None)
+            :logintoken: The user's login token (default None)
+
+        """
+        self._manager = manager
+        self._key = key
         self._nick = nick
         self._logintoken = logintoken
         self._server = None
         self._token = None
-        self._channel = channel
+        self._socket = None
         self._loggedIn = False
-        self._namecolor = "D44F38"
-        self._waitingmessages = []
-        self._nicklist = []
-        self._namessent = True #true initially so we send NAMES on join
-        self._dispatcher = asyncio.Semaphore(value=0)
+        self._clients = {} # channel -> HitboxClient
+        self._joined = set() # channels a joinChannel was sent for
+        self._connected = None
+        self._reconnected = None # future while reconnecting
+        self._closing = False
         self._log = logging.getLogger("ws")
+        self._traffic = logging.getLogger("ws.traffic")
 
-    @asyncio.coroutine
-    def get_servers(self):
-        """Obtain the WS server list from Hitbox.
-            :returns: The array of available servers.
+    def has_room(self, client):
+        """Whether a channel may be added to this connection.
+            :client: The HitboxClient of the channel
 
         """
+        return len(self._clients) < config.channelsPerConnection and \
+            client._channel not in self._clients
 
-        r = yield from aiohttp.request("GET",
-            "{}/chat/servers".format(config.API_URL))
+    def start(self):
+        """Starts connecting in the background.
+            :returns: A future resolving once the websocket is open
 
-        if r.status >= 400:
-            raise IOError(r.status)
-        d = yield from r.read()
+        """
+        if self._connected == None:
+            self._connected = asyncio.async(self.connect())
+        return self._connected
 
-        try:
-            j = json.loads(d.decode())
-        except ValueError:
-            r.close()
-            return None
+    @asyncio.coroutine
+    def get_servers(self):
+        """Obtain the WS server list from the shared server directory.
+            :returns: The array of available servers.
 
-        r.close()
-        return j
+        """
+        return (yield from servers.get_servers())
 
     @asyncio.coroutine
     def select_server(self, list=None):
-        """Obtain a random server from the server list.
+        """Pick one of the fastest healthy servers from the server list.
             :list: List of servers to select from (default None)
             :returns: A string containing a Hitbox WS server.
 
@@ -60,23 +406,29 @@ class HitboxClient:
 
         if list == None:
             list = yield from self.get_servers()
-        self._server = random.choice(list)['server_ip']
+        self._server = servers.select(list)
         return self._server
 
     @asyncio.coroutine
     def get_token(self):
-        """Obtain a token from the selected server.
+        """Obtain a token from the selected server.  The time taken by the
+        handshake is reported to the server directory.
             :returns: The WebSocket ID from the selected server.
 
         """
 
-        r = yield from aiohttp.request("GET",
-            "http://{}/socket.io/1/".format(self._server))
-        d = yield from r.read()
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            d = yield from hitbox_http.request("GET",
+                "http://{}/socket.io/1/".format(self._server))
+        except Exception:
+            servers.report_error(self._server)
+            raise
+        servers.report_rtt(self._server, loop.time() - start)
         d = d.decode("UTF-8").split(":")[0]
         self._token = d
 
-        r.close()
         return d
 
     @asyncio.coroutine
@@ -88,103 +440,1296 @@ class HitboxClient:
 
         yield from self.select_server()
         yield from self.get_token()
-        self._socket = yield from websockets.connect(
-            "ws://{}/socket.io/1/websocket/{}".format(
-                self._server, self._token))
+        try:
+            self._socket = yield from websockets.connect(
+                "ws://{}/socket.io/1/websocket/{}".format(
+                    self._server, self._token))
+        except Exception:
+            servers.report_error(self._server)
+            raise
+        hitbox_metrics.upstream_connects.inc()
 
         return self._socket
 
     @asyncio.coroutine
-    def close_connection(self):
-        """Disconnect from the Hitbox chat server.
-            :returns: True on success, False on error
+    def connect(self):
+        """Connect to a chat server and start receiving incoming messages."""
+        try:
+            yield from self.establish_connection()
+        except Exception:
+            hitbox_metrics.upstream_errors.inc()
+            self._manager.remove(self)
+            raise
+        if self._closing:
+            # The last channel was left during the handshake
+            yield from self._socket.close()
+            return
+        asyncio.async(self.recv())
+
+    @asyncio.coroutine
+    def add(self, client):
+        """Adds a channel to this connection and joins it as soon as the
+        connection is ready.
+            :client: The HitboxClient of the channel
 
         """
+        # Set before waiting, as the channel may be joined as soon as the
+        # connection is up, while the client is still waiting here
+        client._connection = self
+        self._clients[client._channel] = client
+        yield from asyncio.shield(self.start())
+        if self._loggedIn and client._channel not in self._joined:
+            self._joined.add(client._channel)
+            yield from client.joinChannel()
 
+    @asyncio.coroutine
+    def remove(self, client):
+        """Parts a channel and removes it from this connection.  The
+        connection is closed once its last channel is gone.
+            :client: The HitboxClient of the channel
+
+        """
+        if self._clients.get(client._channel) is not client:
+            return
+        del self._clients[client._channel]
         try:
-            yield from self.partChannel()
-            yield from self._socket.close()
+            if client._channel in self._joined:
+                self._joined.discard(client._channel)
+                yield from client.partChannel()
+        finally:
+            if not self._clients:
+                yield from self.close()
+
+    @asyncio.coroutine
+    def reconnect(self):
+        """Reconnects after the websocket dropped.  Attempts are spaced out
+        with a jittered exponential backoff, and the failed server is reported
+        to the server directory so that another one is picked.  Once the new
+        websocket is up, the channels are joined again with the same token as
+        the server greets us; their clients are told they are resuming, so
+        the IRC side does not see them join twice.
+            :returns: True once reconnected, False after giving up
+
+        """
+        servers.report_error(self._server)
+        self._loggedIn = False
+        self._joined.clear()
+        self._reconnected = asyncio.Future()
+        for client in self._clients.values():
+            client._resuming = client._joined
+            # Other sessions in the channel may still be connected
+            if client._subscription != None:
+                client._subscription.elect()
+        attempt = 0
+        while not self._closing and self._clients and \
+            (not config.reconnectAttempts or
+            attempt < config.reconnectAttempts):
+            delay = min(config.reconnectDelay * 2 ** attempt,
+                config.reconnectMaxDelay) * random.uniform(
+                1 - config.reconnectJitter, 1 + config.reconnectJitter)
+            attempt += 1
+            self._log.info("Reconnecting in {:.1f} seconds (attempt {})"
+                .format(delay, attempt))
+            yield from asyncio.sleep(delay)
+            if self._closing:
+                break
+            try:
+                yield from self.establish_connection()
+            except Exception as e:
+                hitbox_metrics.upstream_errors.inc()
+                self._log.warning("Reconnecting to {} failed: {!r}"
+                    .format(self._server, e))
+                continue
+            if self._closing:
+                # The last channel was left during the handshake
+                yield from self._socket.close()
+                break
+            hitbox_metrics.upstream_reconnects.inc()
+            self._log.info("Reconnected to {}".format(self._server))
+            self._reconnected.set_result(True)
+            self._reconnected = None
             return True
-        except:
-            return False
+
+        if not self._closing:
+            self._log.error("Giving up reconnecting after {} attempts"
+                .format(attempt))
+        self._reconnected.set_result(False)
+        self._reconnected = None
+        self._manager.remove(self)
+        for client in list(self._clients.values()):
+            client.connection_lost()
+        return False
 
     @asyncio.coroutine
-    def connect(self):
-        """Connect to a chat server and receive incoming messages."""
-        yield from self.establish_connection()
-        yield from self.recv()
+    def close(self):
+        """Disconnect from the Hitbox chat server."""
+        self._closing = True
+        self._manager.remove(self)
+        if self._socket != None:
+            yield from self._socket.close()
 
     @asyncio.coroutine
     def recv(self):
-        """Get incoming messages as they come in.  Runs until stopped."""
+        """Get incoming messages as they come in and route them to the client
+        of their channel.  Runs until the connection is closed."""
+        loop = asyncio.get_event_loop()
         while True:
             try:
                 msg = yield from self._socket.recv()
             except websockets.exceptions.ConnectionClosed:
-                self._log.debug("Connection closed.  No longer receiving " +
-                    "incoming messages.")
-                break
-            self._log.debug("< {}".format(msg))
+                hitbox_metrics.upstream_closed.inc()
+                if self._closing or not self._clients:
+                    self._log.debug("Connection closed.  No longer " +
+                        "receiving incoming messages.")
+                    self._manager.remove(self)
+                    break
+                self._log.warning("Connection to {} lost".format(
+                    self._server))
+                if not (yield from self.reconnect()):
+                    break
+                continue
+            hitbox_metrics.frames_in.inc()
+            self._traffic.debug("< %s", msg)
 
             if msg == "1::" and not self._loggedIn:
-                self._log.debug("Logging into channel #{}..." \
-                    .format(self._channel))
-                yield from self.joinChannel()
+                self._loggedIn = True
+                for channel, client in list(self._clients.items()):
+                    if channel not in self._joined:
+                        self._log.debug("Logging into channel #{}..." \
+                            .format(channel))
+                        self._joined.add(channel)
+                        yield from client.joinChannel()
             elif msg == "2::":
-                self._log.debug("PING? PONG!")
+                self._traffic.debug("PING? PONG!")
                 yield from self.pong()
+            elif msg.startswith("5:"):
+                if "loginMsg" not in msg and not any(c.is_reader()
+                    for c in self._clients.values()):
+                    # Only used to send: another session reads these channels
+                    continue
+                event = decode_frame(msg[4:])
+                if event == None:
+                    self._log.warning("Undecodable frame: {}".format(msg))
+                    continue
+                event.received = loop.time()
+                client = self._clients.get((event.channel or "").lower())
+                if client == None:
+                    self._log.debug("No channel for %s", event)
+                else:
+                    yield from client.dispatchMessage(event)
+
+    @asyncio.coroutine
+    def send(self, msg):
+        """Send messages to the Hitbox chat server.  While reconnecting, waits
+        until the new websocket is up."""
+        if self._reconnected != None:
+            if not (yield from asyncio.shield(self._reconnected)):
+                raise IOError("Connection to Hitbox lost")
+        yield from self._socket.send(msg)
+        hitbox_metrics.frames_out.inc()
+        self._traffic.debug("> %s", msg)
+
+    @asyncio.coroutine
+    def pong(self):
+        """Responds to server pings with an identical message."""
+        yield from self.send(hitbox_frames.PONG)
+
+class BudgetExceeded(IOError):
+
+    """Raised when no upstream connection may be opened for a channel.
+    numeric is the IRC numeric to answer the JOIN with, and wait the
+    estimated seconds until a connection is free, or None if unknown."""
+
+    def __init__(self, numeric, message, wait=None):
+        """Creates a new exception.
+            :numeric: The IRC numeric, e.g. 437
+            :message: Text of the numeric
+            :wait: Estimated seconds to wait (default None)
+
+        """
+        super().__init__(message)
+        self.numeric = numeric
+        self.wait = wait
+
+class ConnectionBudget:
+
+    """Limits the number of websockets open to Hitbox from this process, as
+    Hitbox limits connections per IP address.  Opening a connection takes a
+    slot of the budget, and closing it gives the slot back.  When the budget
+    is used up, requests wait in line; each user has their own line, and
+    free slots go to the users in turn, so one user joining many channels
+    does not hold up everyone else."""
+
+    def __init__(self, limit=None):
+        """Creates a new budget with all slots free.
+            :limit: Number of slots, 0 for no limit (default
+                config.maxConnections)
+
+        """
+        self.limit = config.maxConnections if limit == None else limit
+        self.used = 0
+        self._users = {} # user -> slots held
+        self._waiting = OrderedDict() # user -> deque of futures, in turn
+        self._interval = None # average seconds between freed slots
+        self._freed = None # time the last slot was freed
+        self._log = logging.getLogger("ws")
+
+    def waiting(self):
+        """Returns the number of requests waiting for a slot."""
+        return sum(len(q) for q in self._waiting.values())
+
+    def estimate(self, position):
+        """Estimates how long a request has to wait for a slot.
+            :position: Position of the request in line
+            :returns: Seconds, or None if slots were never freed yet
+
+        """
+        if self._interval == None:
+            return None
+        return position * self._interval
+
+    def _take(self, user):
+        """Counts a slot as held by a user."""
+        self.used += 1
+        self._users[user] = self._users.get(user, 0) + 1
+
+    @asyncio.coroutine
+    def acquire(self, user, notify=None):
+        """Takes a slot, waiting in line if none is free.
+            :user: The user the slot is for
+            :notify: Called with the position in line and the estimated wait
+                if the request has to wait (default None)
+
+        Raises BudgetExceeded if the user holds too many slots, the line is
+        full or no slot became free within config.joinWaitTimeout seconds.
+
+        """
+        held = self._users.get(user, 0) + len(self._waiting.get(user, ()))
+        if config.userConnections and held >= config.userConnections:
+            raise BudgetExceeded("405", "You have too many Hitbox connections "
+                "open")
+        if not self.limit or (self.used < self.limit and not self._waiting):
+            self._take(user)
+            return
+        position = self.waiting() + 1
+        if position > config.joinQueueSize:
+            raise BudgetExceeded("437", "Too many connections to Hitbox",
+                self.estimate(position))
+        fut = asyncio.Future()
+        self._waiting.setdefault(user, deque()).append(fut)
+        if notify != None:
+            notify(position, self.estimate(position))
+        timer = asyncio.get_event_loop().call_later(config.joinWaitTimeout,
+            self._expire, user, fut)
+        try:
+            yield from fut
+        except asyncio.CancelledError:
+            if not fut.done() or fut.cancelled():
+                self._withdraw(user, fut)
+            elif fut.exception() == None:
+                self.release(user) # granted just as we were cancelled
+            raise
+        finally:
+            timer.cancel()
+
+    def _withdraw(self, user, fut):
+        """Takes a request out of line.
+            :returns: False if it was not in line anymore
+
+        """
+        q = self._waiting.get(user)
+        if q == None or fut not in q:
+            return False
+        q.remove(fut)
+        if not q:
+            del self._waiting[user]
+        return True
+
+    def _expire(self, user, fut):
+        """Gives up on a request that waited too long."""
+        if fut.done() or not self._withdraw(user, fut):
+            return
+        fut.set_exception(BudgetExceeded("437", "Too many connections to "
+            "Hitbox", self.estimate(self.waiting() + 1)))
+
+    def release(self, user):
+        """Gives back a slot, and hands it to the next user in turn.
+            :user: The user holding the slot
+
+        """
+        self.used -= 1
+        held = self._users.get(user, 1) - 1
+        if held:
+            self._users[user] = held
+        else:
+            self._users.pop(user, None)
+        now = asyncio.get_event_loop().time()
+        if self._freed != None:
+            interval = now - self._freed
+            self._interval = interval if self._interval == None else \
+                0.8 * self._interval + 0.2 * interval
+        self._freed = now
+        while self._waiting and self.used < self.limit:
+            user, q = next(iter(self._waiting.items()))
+            fut = q.popleft()
+            if q:
+                self._waiting.move_to_end(user)
             else:
-                json = msg[4:]
-                yield from self.dispatchMessage(json)
+                del self._waiting[user]
+            if not fut.done():
+                self._take(user)
+                fut.set_result(None)
+
+budget = ConnectionBudget()
+
+hitbox_metrics.registry.add(hitbox_metrics.Gauge("hitbox_upstream_connections",
+    "Websockets open to Hitbox", lambda: budget.used))
+hitbox_metrics.registry.add(hitbox_metrics.Gauge(
+    "hitbox_upstream_connection_limit",
+    "Websockets allowed to be open to Hitbox (0 for no limit)",
+    lambda: budget.limit))
+hitbox_metrics.registry.add(hitbox_metrics.Gauge("hitbox_join_queue",
+    "Channels waiting for a free websocket", budget.waiting))
+
+class ConnectionManager:
+
+    """Shares Hitbox connections between the channels of an account, so that a
+    user in many channels only needs a handful of upstream connections.  Each
+    connection carries up to config.channelsPerConnection channels, and
+    opening one takes a slot of the connection budget."""
+
+    def __init__(self):
+        """Creates a new connection manager without any connections."""
+        self._connections = {} # account key -> list of HitboxConnection
+        self._log = logging.getLogger("ws")
+
+    def _find(self, key, client):
+        """Returns a connection of an account with room for a channel, or
+        None."""
+        for conn in self._connections.get(key, ()):
+            if conn.has_room(client):
+                return conn
+        return None
+
+    @asyncio.coroutine
+    def attach(self, client, notify=None):
+        """Adds a channel to a connection of its account, opening a new
+        connection if all existing ones are full.
+            :client: The HitboxClient of the channel
+            :notify: Called if the channel has to wait for a free slot of the
+                connection budget (see ConnectionBudget.acquire)
+            :returns: The HitboxConnection the channel was added to
+
+        """
+        key = (client._nick, client._logintoken)
+        conn = self._find(key, client)
+        if conn == None:
+            yield from budget.acquire(client._nick, notify)
+            # Another channel may have opened a connection in the meantime
+            conn = self._find(key, client)
+            if client._subscription == None:
+                budget.release(client._nick)
+                raise IOError("Channel left while waiting for a connection")
+            if conn != None:
+                budget.release(client._nick)
+            else:
+                conns = self._connections.setdefault(key, [])
+                self._log.debug("Opening connection {} for {}"
+                    .format(len(conns) + 1, client._nick))
+                conn = HitboxConnection(self, key, client._nick,
+                    client._logintoken)
+                conns.append(conn)
+        yield from conn.add(client)
+        return conn
+
+    def remove(self, conn):
+        """Forgets a connection that was closed or failed to connect.
+            :conn: The HitboxConnection to remove
+
+        """
+        conns = self._connections.get(conn._key)
+        if conns != None and conn in conns:
+            conns.remove(conn)
+            if not conns:
+                del self._connections[conn._key]
+            budget.release(conn._nick)
+
+connections = ConnectionManager()
+
+class NickList:
+
+    """The users of a channel, indexed by nick.  Every nick maps to its
+    highest role (admin, mod, sub or reg), so that consecutive userList
+    snapshots can be diffed in time proportional to the channel size instead
+    of resending the whole list."""
+
+    def __init__(self):
+        """Creates a new nick list.  It stays empty until the first snapshot
+        is applied."""
+        self._roles = None # nick -> role
+
+    def __len__(self):
+        return len(self._roles) if self._roles != None else 0
+
+    def has_snapshot(self):
+        """Whether a userList snapshot has been applied yet."""
+        return self._roles != None
+
+    @staticmethod
+    def parse(data):
+        """Builds the nick to role index of a userList snapshot.
+            :data: The data parameter of a userList message
+            :returns: A dictionary of nicks to roles
+
+        """
+        roles = {}
+        for key, role in (("anon", "reg"), ("isSubscriber", "sub"),
+            ("user", "mod"), ("admin", "admin")):
+            for nick in data.get(key, ()):
+                roles[nick] = role
+        return roles
+
+    def update(self, data):
+        """Applies a userList snapshot and works out what changed.
+            :data: The data parameter of a userList message
+            :returns: None if nothing changed or this was the first snapshot,
+                otherwise a tuple of a list of (nick, role) that joined, a
+                list of nicks that parted and a list of (nick, old role, new
+                role) whose role changed
+
+        """
+        new = self.parse(data)
+        old, self._roles = self._roles, new
+        if old == None:
+            return None
+        joined = []
+        changed = []
+        for nick, role in new.items():
+            oldrole = old.get(nick)
+            if oldrole == None:
+                joined.append((nick, role))
+            elif oldrole != role:
+                changed.append((nick, oldrole, role))
+        parted = [nick for nick in old if nick not in new]
+        if not (joined or parted or changed):
+            return None
+        return joined, parted, changed
+
+    def as_data(self):
+        """Rebuilds a userList data parameter from the index.
+            :returns: A dictionary in the format sent by Hitbox
+
+        """
+        data = {"admin": [], "user": [], "isSubscriber": [], "anon": []}
+        for nick, role in (self._roles or {}).items():
+            if role == "admin":
+                data["admin"].append(nick)
+            elif role == "mod":
+                data["user"].append(nick)
+            else:
+                if role == "sub":
+                    data["isSubscriber"].append(nick)
+                data["anon"].append(nick)
+        return data
+
+class FingerprintCache:
+
+    """Remembers the fingerprints of the last chat messages seen, to spot
+    messages sent again.  A fingerprint is the hash of a message's time,
+    nick and text, so the memory used only depends on maxsize.  The least
+    recently seen fingerprint is forgotten first."""
+
+    def __init__(self, maxsize=None):
+        """Creates a new, empty cache.
+            :maxsize: Number of fingerprints kept (default config.dedupeSize)
+
+        """
+        self._maxsize = config.dedupeSize if maxsize == None else maxsize
+        self._seen = OrderedDict() # fingerprint -> None
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, t, name, text):
+        """Records a message and tells whether it was seen before.
+            :t: The message's Hitbox time
+            :name: Nick of the sender
+            :text: The message
+            :returns: True if the message was seen before
+
+        """
+        key = hash((t, name, text))
+        seen = self._seen
+        if key in seen:
+            seen.move_to_end(key)
+            self.hits += 1
+            hitbox_metrics.dedupe_hits.inc()
+            return True
+        seen[key] = None
+        if len(seen) > self._maxsize:
+            seen.popitem(last=False)
+        self.misses += 1
+        hitbox_metrics.dedupe_misses.inc()
+        return False
+
+class ChannelHistory:
+
+    """The recent chat messages of a channel, oldest first.  Messages are
+    kept as (time, nick, text) tuples, at most config.historySize of them
+    and none older than config.historyAge seconds."""
+
+    def __init__(self, channel):
+        """Creates a new, empty history.
+            :channel: The channel name
+
+        """
+        self._channel = channel
+        self._entries = deque(maxlen=config.historySize)
+        self._seen = FingerprintCache()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _prune(self):
+        """Forgets messages older than config.historyAge."""
+        entries = self._entries
+        limit = time.time() - config.historyAge
+        while entries and entries[0][0] < limit:
+            entries.popleft()
+
+    def add(self, event):
+        """Records a chat message.  Buffered history sent by Hitbox on a join
+        is only recorded if it is not already known.
+            :event: The chatMsg HitboxEvent
+            :returns: False if the message was already known
+
+        """
+        t = event.time
+        if not isinstance(t, (int, float)):
+            t = event.time = time.time()
+        if self._seen.seen(t, event.name, event.text) and event.buffer:
+            return False
+        self._entries.append((t, event.name, event.text))
+        return True
+
+    def replay(self):
+        """Returns all recorded messages as (time, nick, text) tuples, oldest
+        first."""
+        self._prune()
+        return list(self._entries)
+
+    def query(self, kind, t=None, limit=None):
+        """Looks up messages for a CHATHISTORY request.
+            :kind: "latest", "before" or "after"
+            :t: Unix time the request is relative to; None for latest means
+                now (default None)
+            :limit: Maximum number of messages (default config.historySize)
+            :returns: A list of (time, nick, text) tuples, oldest first
+
+        """
+        self._prune()
+        limit = config.historySize if limit == None else limit
+        if limit <= 0:
+            return []
+        entries = self._entries
+        if kind == "after":
+            return [e for e in entries if e[0] > t][:limit]
+        if kind == "before":
+            found = [e for e in entries if e[0] < t]
+        elif t == None:
+            found = list(entries)
+        else:
+            found = [e for e in entries if e[0] > t]
+        return found[-limit:]
+
+class ChannelSubscription:
+
+    """The shared read path of a channel.  Every IRC session in a channel has
+    its own HitboxClient to send with, but only the first one attached (the
+    reader) hands its incoming events to the subscription, which fans them
+    out to all attached clients.  The other clients drop what they receive.
+    If the reader leaves, or its connection drops, another client whose
+    connection is up takes over.  Chat is recorded in
+    the channel's ChannelHistory, which is replayed to clients joining
+    later."""
+
+    def __init__(self, channel, history):
+        """Creates a new subscription without any clients.
+            :channel: The channel name
+            :history: The ChannelHistory of the channel
+
+        """
+        self._channel = channel
+        self._clients = []
+        self.history = history
+        self.nicklist = NickList()
+        self.activity = 0 # events since the last nick list refresh
+        self.quietpolls = 0 # refreshes in a row without any activity
+        self._log = logging.getLogger("ws")
+
+    @property
+    def reader(self):
+        """The client whose events are fanned out, or None."""
+        return self._clients[0] if self._clients else None
+
+    def attach(self, client):
+        """Adds a client to the subscription.
+            :client: The HitboxClient to add
+
+        """
+        self._clients.append(client)
+
+    def detach(self, client):
+        """Removes a client from the subscription.
+            :client: The HitboxClient to remove
+            :returns: True if no clients are left
+
+        """
+        if client not in self._clients:
+            return not self._clients
+        wasreader = client is self.reader
+        self._clients.remove(client)
+        if not self._clients:
+            nicklists.remove(self)
+            return True
+        if wasreader and not self.elect():
+            self._handover()
+        return False
+
+    def elect(self):
+        """Hands the reader role to a client whose connection is up, if the
+        reader's is not.  Called when the reader leaves, and when a
+        connection starts or finishes reconnecting.
+            :returns: True if the reader changed
+
+        """
+        reader = self.reader
+        if reader == None or reader.is_live():
+            return False
+        for client in self._clients:
+            if client.is_live():
+                self._clients.remove(client)
+                self._clients.insert(0, client)
+                self._handover()
+                return True
+        return False
+
+    def _handover(self):
+        """Called when a new client became the reader."""
+        self._log.debug("{} now reads #{}".format(self.reader._nick,
+            self._channel))
+        if self.reader._joined and not nicklists.scheduled(self):
+            nicklists.add(self)
+
+    @asyncio.coroutine
+    def publish(self, event):
+        """Hands an event received by the reader to every attached client that
+        has joined the channel.  A userList snapshot is diffed once against
+        the channel's nick list; clients waiting for a full list get the
+        snapshot and all others only get the changes.  Chat messages are
+        recorded in the history, and buffered history that was recorded
+        before (sent by Hitbox again after a rejoin) is dropped.
+
+        Only the reader's own queue may make us wait for room (with the
+        "pause" policy), as the reader stops reading its websocket meanwhile;
+        the queues of the other sessions drop what does not fit, so that one
+        stalled session cannot hold up the others.
+            :event: The decoded HitboxEvent
+
+        """
+        if event.method == "chatMsg" and not self.history.add(event):
+            return
+        if event.method == "slowMsg":
+            slow = event.params.get("slowTime", event.params.get("time"))
+            for client in self._clients:
+                client._limiter.set_slow(slow or 0)
+        clients = [c for c in self._clients if c._joined]
+        if event.method == "userList":
+            delta = yield from self.reader._calculateDelta(event)
+            if delta != None:
+                self.activity += 1
+            out = []
+            for client in clients:
+                if client._namessent:
+                    client._namessent = False
+                    out.append((client, event))
+                elif delta != None:
+                    out.append((client, delta))
+        else:
+            self.activity += 1
+            out = [(client, event) for client in clients]
+        reader = self.reader
+        for client, e in out:
+            if client is not reader:
+                client.offer(e)
+        for client, e in out:
+            if client is reader:
+                yield from client.deliver(e)
+
+    def watched(self):
+        """Whether any joined IRC session is reading this channel."""
+        return any(c._joined for c in self._clients)
+
+    @asyncio.coroutine
+    def refreshNickList(self):
+        """Asks the reader for the channel's nick list.
+            :returns: False if there was nobody to ask
+
+        """
+        reader = self.reader
+        if reader == None or not reader._joined or reader._connection == None:
+            return False
+        self._log.debug("Updating Nick List for {}".format(self._channel))
+        yield from reader.userList()
+        return True
+
+class SubscriptionRegistry:
+
+    """Keeps the ChannelSubscription of every channel joined by any IRC
+    session, so that each channel is only read once.  The ChannelHistory of
+    a channel outlives its subscription; the histories of the
+    config.historyChannels channels used most recently are kept."""
+
+    def __init__(self):
+        """Creates a new registry without any subscriptions."""
+        self._subscriptions = {} # channel -> ChannelSubscription
+        self._history = OrderedDict() # channel -> ChannelHistory
+
+    def history(self, channel):
+        """Returns the ChannelHistory of a channel, creating it if needed.
+            :channel: The channel name
+
+        """
+        history = self._history.pop(channel, None)
+        if history == None:
+            history = ChannelHistory(channel)
+        self._history[channel] = history
+        if len(self._history) > config.historyChannels:
+            for c in list(self._history):
+                if c not in self._subscriptions and c != channel:
+                    del self._history[c]
+                    break
+        return history
+
+    def attach(self, client):
+        """Adds a client to the subscription of its channel, creating it if
+        needed.
+            :client: The HitboxClient to add
+            :returns: The ChannelSubscription
+
+        """
+        sub = self._subscriptions.get(client._channel)
+        if sub == None:
+            sub = self._subscriptions[client._channel] = \
+                ChannelSubscription(client._channel,
+                self.history(client._channel))
+        sub.attach(client)
+        return sub
+
+    def detach(self, client):
+        """Removes a client from the subscription of its channel, dropping the
+        subscription once no clients are left.
+            :client: The HitboxClient to remove
+
+        """
+        sub = self._subscriptions.get(client._channel)
+        if sub != None and sub.detach(client):
+            del self._subscriptions[client._channel]
+
+subscriptions = SubscriptionRegistry()
+
+class NickListScheduler:
+
+    """Owns the nick list refreshes of every channel.  A single task sleeps
+    until the next channel is due, so hundreds of channels do not need
+    hundreds of timers.  The interval of a channel adapts to it: large
+    channels are refreshed less often, busy channels more often and quiet
+    channels back off further with every refresh that saw no activity.  A
+    random jitter keeps refreshes of channels joined together from lining
+    up."""
+
+    def __init__(self):
+        """Creates a new scheduler without any channels."""
+        self._heap = [] # (due time, sequence number, subscription)
+        self._due = {} # subscription -> due time, missing once removed
+        self._seq = 0
+        self._wakeup = None
+        self._task = None
+        self._log = logging.getLogger("ws")
+
+    def add(self, sub, delay=0):
+        """Schedules the nick list refresh of a channel, replacing any
+        refresh already scheduled for it.
+            :sub: The ChannelSubscription of the channel
+            :delay: Seconds until the refresh (default 0)
+
+        """
+        due = asyncio.get_event_loop().time() + delay
+        self._due[sub] = due
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, sub))
+        if self._task == None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.async(self.run())
+        elif self._heap[0][2] is sub:
+            self._wakeup.set()
+
+    def scheduled(self, sub):
+        """Whether a refresh is scheduled for a channel."""
+        return sub in self._due
+
+    def remove(self, sub):
+        """Stops refreshing the nick list of a channel.
+            :sub: The ChannelSubscription of the channel
+
+        """
+        self._due.pop(sub, None)
+        if not self._due and self._task != None:
+            self._task.cancel()
+            self._task = None
+            self._heap = []
+
+    def interval(self, sub, elapsed):
+        """Works out when a channel should be refreshed next.
+            :sub: The ChannelSubscription of the channel
+            :elapsed: Seconds since its previous refresh
+            :returns: Seconds until the next refresh
+
+        """
+        interval = config.nickListInterval
+        users = len(sub.nicklist)
+        if users > config.nickListLargeChannel:
+            interval *= users / config.nickListLargeChannel
+        if sub.activity / max(elapsed, 1.0) >= config.nickListBusyRate:
+            interval /= 2
+        elif sub.quietpolls:
+            interval *= 2 ** min(sub.quietpolls, 4)
+        interval = min(max(interval, config.nickListMinInterval),
+            config.nickListMaxInterval)
+        return interval * random.uniform(1 - config.nickListJitter,
+            1 + config.nickListJitter)
+
+    @asyncio.coroutine
+    def run(self):
+        """Refreshes nick lists as they become due.  Runs until the last
+        channel is removed."""
+        loop = asyncio.get_event_loop()
+        last = {} # subscription -> time of its previous refresh
+        while self._heap:
+            due, _, sub = self._heap[0]
+            if self._due.get(sub) != due:
+                heapq.heappop(self._heap) # removed or rescheduled
+                if sub not in self._due:
+                    last.pop(sub, None)
+                continue
+            now = loop.time()
+            if due > now:
+                self._wakeup.clear()
+                try:
+                    yield from asyncio.wait_for(self._wakeup.wait(), due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+
+            if sub.watched():
+                try:
+                    yield from sub.refreshNickList()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._log.warning("Nick list refresh of #{} failed: {!r}"
+                        .format(sub._channel, e))
+            elapsed = now - last.get(sub, now - config.nickListInterval)
+            last[sub] = now
+            sub.quietpolls = 0 if sub.activity else sub.quietpolls + 1
+            delay = self.interval(sub, elapsed)
+            sub.activity = 0
+            if sub in self._due:
+                self.add(sub, delay)
+        self._task = None
+
+nicklists = NickListScheduler()
+
+def split_text(text, limit):
+    """Splits text into pieces of at most limit characters, at spaces where
+    possible.
+        :text: The text to split
+        :limit: Longest piece allowed
+        :returns: A list of the pieces
+
+    """
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            pieces.append(text[:limit])
+            text = text[limit:]
+        else:
+            pieces.append(text[:cut])
+            text = text[cut + 1:]
+    if text:
+        pieces.append(text)
+    return pieces
+
+class SendLimiter:
+
+    """Paces the chat messages a client sends to its channel with a token
+    bucket, so that pasting many lines does not get them rejected or the
+    websocket kicked for flooding.  Up to config.sendBurst messages are sent
+    at once, then config.sendRate per second; while the channel is in slow
+    mode, one message per slow mode interval.  Moderators are only held to
+    the flood limit.  Messages waiting to be sent are queued, at most
+    config.sendQueueSize of them."""
+
+    def __init__(self, client):
+        """Creates a new limiter with a full bucket.
+            :client: The HitboxClient sending the messages
+
+        """
+        self._client = client
+        self._queue = deque()
+        self._tokens = config.sendBurst
+        self._last = asyncio.get_event_loop().time()
+        self._slow = 0
+        self._task = None
+        self.exempt = False # not affected by slow mode
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def set_slow(self, seconds):
+        """Sets the slow mode interval of the channel.
+            :seconds: Seconds between messages, 0 if slow mode is off
+
+        """
+        self._refill()
+        try:
+            self._slow = max(float(seconds), 0)
+        except (TypeError, ValueError):
+            self._slow = 0
+
+    def _limits(self):
+        """Returns the current rate, in messages per second, and burst."""
+        if self._slow and not self.exempt:
+            return min(config.sendRate, 1 / self._slow), 1
+        return config.sendRate, config.sendBurst
+
+    def _refill(self):
+        """Adds the tokens earned since the last refill to the bucket."""
+        now = asyncio.get_event_loop().time()
+        rate, burst = self._limits()
+        self._tokens = min(burst, self._tokens + (now - self._last) * rate)
+        self._last = now
+
+    @asyncio.coroutine
+    def put(self, text):
+        """Queues a chat message, split into pieces Hitbox accepts.  Pieces
+        that do not fit in the queue are dropped, and the IRC side is told.
+            :text: The message
+
+        """
+        pieces = split_text(text, config.messageLength)
+        room = config.sendQueueSize - len(self._queue)
+        if len(pieces) > room:
+            dropped = len(pieces) - max(room, 0)
+            pieces = pieces[:max(room, 0)]
+            yield from self.report(dropped, "too many messages queued")
+        self._queue.extend(pieces)
+        if self._queue and self._task == None:
+            self._task = asyncio.async(self.run())
+
+    @asyncio.coroutine
+    def report(self, count, reason):
+        """Tells the IRC side that messages were not sent.
+            :count: Number of messages
+            :reason: Why they were not sent
+
+        """
+        self.dropped += count
+        yield from self._client.deliver(HitboxEvent("sendDropped", {
+            "channel": self._client._channel,
+            "count": count,
+            "reason": reason
+        }))
+
+    @asyncio.coroutine
+    def run(self):
+        """Sends the queued messages as the bucket allows.  Runs until the
+        queue is empty."""
+        try:
+            while self._queue:
+                self._refill()
+                if self._tokens < 1:
+                    rate, _ = self._limits()
+                    yield from asyncio.sleep((1 - self._tokens) / rate)
+                    continue
+                self._tokens -= 1
+                text = self._queue.popleft()
+                try:
+                    yield from self._client.send(
+                        self._client._frames.chat(text))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    count = len(self._queue) + 1
+                    self._queue.clear()
+                    yield from self.report(count, "could not send ({!r})"
+                        .format(e))
+        finally:
+            self._task = None
+
+    def close(self):
+        """Stops sending and forgets the queued messages."""
+        self._queue.clear()
+        if self._task != None:
+            self._task.cancel()
+            self._task = None
+
+class HitboxClient:
+
+    """Handles a single channel of Hitbox WS Chat for one IRC session.  The
+    websocket itself is shared with the account's other channels through the
+    ConnectionManager, and incoming events are shared with other sessions in
+    the same channel through its ChannelSubscription."""
+
+    def __init__(self, channel, nick=None, logintoken=None):
+        """Creates a new Hitbox Client.
+            :channel: The channel to join
+            :nick: The user's Hitbox nickname (default None)
+            :logintoken: The user's login token (default None)
+
+        """
+
+        self._nick = nick
+        self._logintoken = logintoken
+        self._connection = None
+        self._subscription = None
+        self._joined = False
+        self._resuming = False # rejoining after the connection was lost
+        self._lost = False # the connection was lost for good
+        self._counted = False # counted in the clients gauge
+        self._connecting = None # task adding us to a connection
+        self._channel = channel
+        self._namecolor = "D44F38"
+        self._frames = hitbox_frames.FrameEncoder(channel, nick, logintoken,
+            self._namecolor)
+        self._waitingmessages = EventQueue()
+        self._limiter = SendLimiter(self)
+        self._nicklist = None
+        self._namessent = True #true initially so we send NAMES on join
+        self._log = logging.getLogger("ws")
+
+    @asyncio.coroutine
+    def connect(self, notify=None):
+        """Adds this channel to a connection of the account.  Incoming
+        messages are queued and may be read with getNextMessage().
+            :notify: Called with the position in line and the estimated wait
+                if the channel has to wait for a free connection (default
+                None)
+
+        """
+        self._subscription = subscriptions.attach(self)
+        self._nicklist = self._subscription.nicklist
+        # A task, so that leaving the channel can take it out of the line for
+        # a free connection
+        self._connecting = asyncio.async(connections.attach(self, notify))
+        try:
+            self._connection = yield from self._connecting
+        except asyncio.CancelledError:
+            subscriptions.detach(self)
+            self._subscription = None
+            self._connection = None
+            raise IOError("Channel left while waiting for a connection")
+        except Exception:
+            subscriptions.detach(self)
+            self._subscription = None
+            self._connection = None
+            raise
+        finally:
+            self._connecting = None
+        if self._subscription == None:
+            # Left while connecting; close_connection() already cleaned up
+            self._connection = None
+            raise IOError("Channel left while connecting")
+        self._counted = True
+        hitbox_metrics.clients.inc()
+
+    def is_live(self):
+        """Whether this client has joined its channel on a connection that is
+        up."""
+        conn = self._connection
+        return self._joined and not self._resuming and conn != None and \
+            conn._reconnected == None
+
+    def is_reader(self):
+        """Whether this client reads the channel for all sessions in it."""
+        return self._subscription != None and \
+            self._subscription.reader is self
+
+    @asyncio.coroutine
+    def close_connection(self):
+        """Leave the channel.  The websocket is closed once none of the
+        account's channels use it anymore.
+            :returns: True on success, False on error
+
+        """
+
+        conn, self._connection = self._connection, None
+        if conn == None and self._connecting != None:
+            # Still waiting for a free connection
+            self._connecting.cancel()
+        if self._counted:
+            self._counted = False
+            hitbox_metrics.clients.dec()
+        subscriptions.detach(self)
+        self._subscription = None
+        self._joined = False
+        self._limiter.close()
+        self._waitingmessages.close()
+        try:
+            yield from conn.remove(self)
+            return True
+        except:
+            return False
+
+    def connection_lost(self):
+        """Called by the connection when it gave up reconnecting.  The
+        message queue is closed, so getNextMessage() returns None."""
+        self._lost = True
+        self._joined = False
+        self._resuming = False
+        self._limiter.close()
+        self._waitingmessages.close()
 
     @asyncio.coroutine
     def send(self, msg):
         """Send messages to the Hitbox chat server."""
-        yield from self._socket.send(msg)
-        self._log.debug("> {}".format(msg))
+        yield from self._connection.send(msg)
 
     @asyncio.coroutine
-    def updateNickListEveryTen(self):
-        """Loops infinitely and calls the nicklist updater every 10 seconds."""
-        self._log.debug("Nicklist updater called")
-        while True:
-            self._log.debug("Updating Nick List for {}".format(self._channel))
-            yield from self.userList()
-            yield from asyncio.sleep(10.0)
+    def command(self, name, **args):
+        """Send a command to the Hitbox chat server.
+            :name: Name of the command in hitbox_frames.COMMANDS
+            :args: The command's arguments
+
+        """
+        yield from self.send(self._frames.encode(name, args))
 
     @asyncio.coroutine
     def getNextMessage(self):
-        """Grabs the next incoming message and sends it to the object using the
-        socket.  Blocks if a message is not available."""
-        yield from self._dispatcher.acquire()
-        return self._waitingmessages.pop(0)
+        """Grabs the next incoming event and sends it to the object using the
+        socket.  Blocks if an event is not available.
+            :returns: A HitboxEvent, or None once the channel was left
+
+        """
+        return (yield from self._waitingmessages.get())
 
     @asyncio.coroutine
-    def dispatchMessage(self, msg):
-        """Adds a message to the message queue and signals that a message is
-        available, unblocking anything calling getNextMessage()"""
-        try:
-            msg["args"]["method"] # this will throw an error normally
-        except TypeError:
-            self._log.debug(msg)
-            args = json.loads(json.loads(msg)["args"][0])
-            if args["method"] == "loginMsg":
-                asyncio.async(self.updateNickListEveryTen())
-            if args["method"] == "userList":
-                if self._namessent:
-                    self._namessent = False # disable sending list after a dispatch
-                else:
-                    msg = yield from self._calculateDelta(msg)
-        self._waitingmessages.append(msg)
-        self._dispatcher.release()
-        self._log.debug("Message dispatched.  Sem: {}" \
-            .format(repr(self._dispatcher)))
+    def dispatchMessage(self, event):
+        """Handles an event received on this client's connection.  Our own
+        join confirmation is queued directly, unless it confirms a rejoin
+        after a reconnect; anything else is fanned out to the channel's
+        sessions if this client is the reader, and dropped otherwise.
+            :event: The decoded HitboxEvent
+
+        """
+        if event.method == "loginMsg":
+            resumed, self._resuming = self._resuming, False
+            self._joined = True
+            # Take the reader role back if the reader is not connected
+            self._subscription.elect()
+            self._limiter.exempt = event.params.get("role") in \
+                ("user", "admin")
+            if self.is_reader() and (resumed or
+                not self._nicklist.has_snapshot()):
+                # After a reconnect, the next userList is diffed against the
+                # nick list from before, catching up on what was missed
+                nicklists.add(self._subscription)
+            if resumed:
+                self._log.info("Rejoined #{}".format(self._channel))
+                return
+            yield from self.deliver(event)
+            # Recent chat is replayed from memory, as a single event; Hitbox's
+            # own copy of it is dropped as it arrives (see
+            # ChannelSubscription.publish)
+            entries = self._subscription.history.replay()
+            if entries:
+                yield from self.deliver(HitboxEvent("chatHistory", {
+                    "channel": self._channel,
+                    "entries": entries,
+                    "buffer": True
+                }))
+            if self._namessent and self._nicklist.has_snapshot():
+                # The channel is already being read, no need to wait for the
+                # next userList
+                self._namessent = False
+                yield from self.deliver(self._snapshot())
+        elif self.is_reader():
+            yield from self._subscription.publish(event)
+
+    @asyncio.coroutine
+    def deliver(self, event):
+        """Adds an event to the message queue, unblocking anything calling
+        getNextMessage().  If the queue is full, its overflow policy applies.
+            :event: The decoded HitboxEvent
+
+        """
+        yield from self._waitingmessages.put(event)
+        self._log.debug("Message dispatched.  Queue depth: %d",
+            len(self._waitingmessages))
+
+    def offer(self, event):
+        """Adds an event to the message queue without waiting, dropping
+        events if the queue is full (see EventQueue.offer()).
+            :event: The decoded HitboxEvent
+
+        """
+        self._waitingmessages.offer(event)
+
+    @asyncio.coroutine
+    def _calculateDelta(self, event):
+        """Diffs a userList snapshot against the channel's nick list and
+        updates the list.
+            :event: The userList HitboxEvent
+            :returns: A userDelta HitboxEvent holding the joined, parted and
+                changed nicks, or None if there is nothing to send
+
+        """
+        delta = self._nicklist.update(event.params.get("data") or {})
+        if delta == None:
+            return None
+        joined, parted, changed = delta
+        self._log.debug("Nick list delta for {}: {} joined, {} parted, {} "
+            "changed".format(self._channel, len(joined), len(parted),
+            len(changed)))
+        delta = HitboxEvent("userDelta", {
+            "channel": event.channel,
+            "joined": joined,
+            "parted": parted,
+            "changed": changed
+        })
+        delta.received = event.received
+        return delta
+
+    def _snapshot(self):
+        """Builds a userList event from the channel's current nick list."""
+        return HitboxEvent("userList", {
+            "channel": self._channel,
+            "data": self._nicklist.as_data()
+        })
 
     @asyncio.coroutine
-    def _calculateDelta(self, msg):
-        #oldnicklist = self._nicklist
-        #newnicklist = msg["args"]["params"]["data"]
-        return msg #TODO
+    def names(self):
+        """Queues the full nick list of the channel for a NAMES reply.  The
+        channel's current list is used if there is one; otherwise the next
+        userList received is sent in full."""
+        if self._nicklist != None and self._nicklist.has_snapshot():
+            yield from self.deliver(self._snapshot())
+        else:
+            yield from self.signalNames()
+            if self.is_reader() and self._joined:
+                yield from self.userList()
 
     @asyncio.coroutine
     def signalNames(self):
@@ -197,98 +1742,35 @@ class HitboxClient:
     @asyncio.coroutine
     def joinChannel(self):
         """Joins the channel this socket is assigned to."""
-        prefix = "5:::"
-        if self._nick == None:
-            nick = "UnknownSoldier"
-        else:
-            nick = self._nick
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "joinChannel",
-                    "params": {
-                        "channel": self._channel,
-                        "name": nick,
-                        "token": self._logintoken,
-                        "isAdmin": False
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("joinChannel")
 
     @asyncio.coroutine
     def partChannel(self):
         """Logs out of the channel.  This should be called before closing the
         socket."""
-        prefix = "5:::"
-        if self._nick == None:
-            nick = "UnknownSoldier"
-        else:
-            nick = self._nick
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "partChannel",
-                    "params": {
-                        "name": nick
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
-
-    @asyncio.coroutine
-    def pong(self):
-        """Responds to server pings with an identical message."""
-        yield from self.send("2::")
+        yield from self.command("partChannel")
 
     @asyncio.coroutine
     def userList(self):
         """Requests the user list from a channel."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "getChannelUserList",
-                    "params": {
-                        "channel": self._channel
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("userList")
 
     @asyncio.coroutine
     def userInfo(self, nick):
         """Get information about a user including it's roles.
             :nick: Nick to get information about
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "getChannelUser",
-                    "params": {
-                        "channel": self._channel,
-                        "name": nick
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("userInfo", nick=nick)
 
     @asyncio.coroutine
     def getChatColors(self):
-        """Get valid chat colors you can use."""
-        r = yield from aiohttp.request("GET",
+        """Get valid chat colors you can use.
+            :returns: The parsed color list
+
+        """
+        d = yield from hitbox_http.request("GET",
             "{}/chat/colors".format(config.API_URL))
-        d = yield from r.read()
-        j = json.loads(d)
+        return json.loads(d.decode("UTF-8"))
 
     @asyncio.coroutine
     def timeout(self, nick, time=300):
@@ -298,22 +1780,7 @@ class HitboxClient:
             :time: Number of seconds to ban
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "kickUser",
-                    "params": {
-                        "channel": self._channel,
-                        "name": nick,
-                        "token": self._logintoken,
-                        "timeout": time
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("timeout", nick=nick, time=time)
 
     @asyncio.coroutine
     def ban(self, nick):
@@ -321,20 +1788,7 @@ class HitboxClient:
             :nick: Target nickname
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "banUser",
-                    "params": {
-                        "channel": self._channel,
-                        "name": nick
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("ban", nick=nick)
 
     @asyncio.coroutine
     def ipban(self, nick):
@@ -343,22 +1797,7 @@ class HitboxClient:
             :nick: Target nickname
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "banUser",
-                    "params": {
-                        "channel": self._channel,
-                        "name": nick,
-                        "token": self._logintoken,
-                        "banIP": True
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("ipban", nick=nick)
 
     @asyncio.coroutine
     def unban(self, nick):
@@ -366,21 +1805,7 @@ class HitboxClient:
             :nick: Target nickname
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "unbanUser",
-                    "params": {
-                        "channel": self._channel,
-                        "name": nick,
-                        "token": self._logintoken
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("unban", nick=nick)
 
     @asyncio.coroutine
     def addMod(self, nick):
@@ -389,21 +1814,7 @@ class HitboxClient:
             :nick: Target nickname
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "makeMod",
-                    "params": {
-                        "channel": self._channel,
-                        "name": nick,
-                        "token": self._logintoken
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("addMod", nick=nick)
 
     @asyncio.coroutine
     def removeMod(self, nick):
@@ -412,21 +1823,7 @@ class HitboxClient:
             :nick: Target nickname
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "removeMod",
-                    "params": {
-                        "channel": self._channel,
-                        "name": nick,
-                        "token": self._logintoken
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("removeMod", nick=nick)
 
     @asyncio.coroutine
     def setSlow(self, time=0):
@@ -435,83 +1832,29 @@ class HitboxClient:
             :time: Number of seconds to delay
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "slowMode",
-                    "params": {
-                        "channel": self._channel,
-                        "time": time
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("setSlow", time=time)
 
     @asyncio.coroutine
     def enableSubOnly(self):
         """Restrict chatting to channel subscribers.  Moderators and higher may
         still chat."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "slowMode",
-                    "params": {
-                        "channel": self._channel,
-                        "subscriber": True,
-                        "rate": 0
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("enableSubOnly")
 
     @asyncio.coroutine
     def disableSubOnly(self):
         """Lift the restriction on chatting and allow everyone to talk."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "slowMode",
-                    "params": {
-                        "channel": self._channel,
-                        "subscriber": False,
-                        "rate": 0
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("disableSubOnly")
 
     @asyncio.coroutine
     def sendMessage(self, text):
-        """Send a message to the current channel.  Will be rejected if slow mode
-        or subscriber mode is preventing you from talking.
-            :text: Text to send.  Limited to 300 characters
-
-        """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "chatMsg",
-                    "params": {
-                        "channel": self._channel,
-                        "name": self._nick,
-                        "nameColor": self._namecolor,
-                        "text": text
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        """Send a message to the current channel.  Will be rejected if
+        subscriber mode is preventing you from talking.  Messages are paced
+        to respect slow mode and flood limits (see SendLimiter).
+            :text: Text to send.  Split into several messages if longer than
+                config.messageLength characters
+
+        """
+        yield from self._limiter.put(text)
 
     @asyncio.coroutine
     def sendDM(self, nick, text):
@@ -521,23 +1864,7 @@ class HitboxClient:
             :text: Text to send
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "directMsg",
-                    "params": {
-                        "channel": self._channel,
-                        "from": self._nick,
-                        "to": nick,
-                        "nameColor": self._namecolor,
-                        "text": text
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("sendDM", nick=nick, text=text)
 
     @asyncio.coroutine
     def setSticky(self, msg=""):
@@ -545,23 +1872,7 @@ class HitboxClient:
             :msg: Message to stick.  Omit to remove
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "motdMsg",
-                    "params": {
-                        "channel": self._channel,
-                        "name": self._nick,
-                        "nameColor": self._namecolor,
-                        "text": msg,
-                        "time": self.get_timestamp()
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("setSticky", msg=msg)
 
     @asyncio.coroutine
     def startPoll(self, question, choices, subscribersOnly, followersOnly):
@@ -573,25 +1884,9 @@ class HitboxClient:
             :followersOnly: Boolean indicating whether followers only can vote
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "createPoll",
-                    "params": {
-                        "channel": self._channel,
-                        "question": question,
-                        "choices": choices,
-                        "subscribersOnly": subscribersOnly,
-                        "followersOnly": followersOnly,
-                        "start_time": self.get_timestamp(),
-                        "nameColor": self._namecolor
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("startPoll", question=question,
+            choices=choices, subscribersOnly=subscribersOnly,
+            followersOnly=followersOnly)
 
     @asyncio.coroutine
     def pollVote(self, choice):
@@ -599,77 +1894,23 @@ class HitboxClient:
             :choice: Integer indicating vote.  Starts at 0
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "voteMsg",
-                    "params": {
-                        "name": self._nick,
-                        "channel": self._channel,
-                        "choice": choice,
-                        "token": self._logintoken
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("pollVote", choice=choice)
 
     @asyncio.coroutine
     def pausePoll(self):
         """Pause the active poll."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "pausePoll",
-                    "params": {
-                        "channel": self._channel,
-                        "token": self._logintoken
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("pausePoll")
 
     @asyncio.coroutine
     def restartPoll(self):
         """Restart the active poll."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "startPoll",
-                    "params": {
-                        "channel": self._channel,
-                        "token": self._logintoken
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("restartPoll")
 
     @asyncio.coroutine
     def endPoll(self):
         """End the active poll.  Once you end a poll, you cannot restart it -
         you must create a new poll."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "endPoll",
-                    "params": {
-                        "channel": self._channel,
-                        "token": self._logintoken
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("endPoll")
 
     @asyncio.coroutine
     def createRaffle(self, question, prize, choices, subscribersOnly, followersOnly):
@@ -681,78 +1922,25 @@ class HitboxClient:
             :followersOnly: Whether to limit to followers
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "createRaffle",
-                    "params": {
-                        "channel": self._channel,
-                        "question": question,
-                        "prize": prize,
-                        "choices": choices,
-                        "subscribersOnly": subscribersOnly,
-                        "followersOnly": followersOnly,
-                        "start_time": self.get_timestamp(),
-                        "nameColor": self._namecolor
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("createRaffle", question=question,
+            prize=prize, choices=choices, subscribersOnly=subscribersOnly,
+            followersOnly=followersOnly)
 
     @asyncio.coroutine
     def pauseRaffle(self):
         """Pauses the active giveaway."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "pauseRaffle",
-                    "params": {
-                        "channel": self._channel
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("pauseRaffle")
 
     @asyncio.coroutine
     def endRaffle(self):
         """Ends the active giveaway.  You must be in this state in order to pick
         a winner."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "endRaffle",
-                    "params": {
-                        "channel": self._channel
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("endRaffle")
 
     @asyncio.coroutine
     def restartRaffle(self):
         """Resumes the giveaway if it is in a paused state."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "startRaffle",
-                    "params": {
-                        "channel": self._channel
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("restartRaffle")
 
     @asyncio.coroutine
     def raffleVote(self, choice):
@@ -760,21 +1948,7 @@ class HitboxClient:
             :choice: Integer indicating choice (starts at 0)
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "voteRaffle",
-                    "params": {
-                        "name": self._nick,
-                        "channel": self._channel,
-                        "choice": choice
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("raffleVote", choice=choice)
 
     @asyncio.coroutine
     def pickRaffleWinner(self, choice):
@@ -782,57 +1956,19 @@ class HitboxClient:
             :choice: Winning choice
 
         """
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "winnerRaffle",
-                    "params": {
-                        "channel": self._channel,
-                        "answer": choice
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("pickRaffleWinner", choice=choice)
 
     @asyncio.coroutine
     def hideRaffle(self):
         """Hides the raffle from the UI."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "hideRaffle",
-                    "params": {
-                        "channel": self._channel
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("hideRaffle")
 
     @asyncio.coroutine
     def cleanupRaffle(self):
         """Clears the giveaway after ending it and picking the winner."""
-        prefix = "5:::"
-        j = json.dumps({
-            "name": "message",
-            "args": [
-                {
-                    "method": "cleanupRaffle",
-                    "params": {
-                        "channel": self._channel
-                    }
-                }
-            ]
-        })
-        yield from self.send(prefix + j)
+        yield from self.command("cleanupRaffle")
 
     def get_timestamp(self):
         """Obtains the current timestamp in the format that the Hitbox API needs
         it in."""
-        return datetime.datetime.now() \
-            .strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+        return hitbox_frames.timestamp()
@@ -0,0 +1,100 @@
+# vim: sts=4:sw=4:et:tw=80:nosta
+"""Logging setup of the proxy.  Log calls on the event loop only merge their
+arguments into the message and put the record on a bounded queue; formatting
+and writing happen on a separate thread, so a slow terminal or disk cannot
+stall chat delivery.  The per-line traffic loggers (irc.traffic and
+ws.traffic) can additionally be sampled."""
+import atexit, config, copy, logging, logging.handlers, queue, random
+
+class SamplingFilter(logging.Filter):
+
+    """Lets through only a fraction of the records below WARNING."""
+
+    def __init__(self, rate):
+        """Creates a new filter.
+            :rate: Fraction of the records to keep, between 0 and 1
+
+        """
+        super().__init__()
+        self._rate = rate
+
+    def filter(self, record):
+        """Decides whether a record is logged.
+            :record: The LogRecord
+            :returns: True to keep the record
+
+        """
+        if record.levelno >= logging.WARNING or self._rate >= 1:
+            return True
+        return random.random() < self._rate
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    """Puts records on the queue with their arguments merged into the
+    message, as the objects passed to a log call may change before the
+    listener thread gets to them.  Unlike QueueHandler, the message is not
+    formatted here but by the listener thread, and records are dropped rather
+    than blocking the event loop when the queue is full."""
+
+    def __init__(self, q):
+        """Creates a new handler.
+            :q: The queue.Queue to put records on
+
+        """
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Merges the arguments of a record into its message.  This only runs
+        for records that are logged, so disabled log calls stay cheap.
+            :record: The LogRecord
+            :returns: A copy of the record with the merged message
+
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        """Puts a record on the queue, or drops it if the queue is full.
+            :record: The prepared LogRecord
+
+        """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_listener = None
+
+def setup(names):
+    """Sends the given loggers to stderr through the background thread.
+        :names: Names of the loggers to set up
+
+    """
+    global _listener
+    if _listener != None:
+        return
+    q = queue.Queue(config.logQueueSize)
+    ch = logging.StreamHandler()
+    ch.setLevel(config.logLevel)
+    ch.setFormatter(logging.Formatter(config.logFormat))
+    qh = DroppingQueueHandler(q)
+    for x in names:
+        log = logging.getLogger(x)
+        log.setLevel(config.logLevel)
+        log.addHandler(qh)
+    for name, rate in config.logSampling.items():
+        if rate < 1:
+            logging.getLogger(name).addFilter(SamplingFilter(rate))
+    _listener = logging.handlers.QueueListener(q, ch)
+    _listener.start()
+    atexit.register(stop)
+
+def stop():
+    """Writes out the queued records and stops the background thread."""
+    global _listener
+    if _listener != None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,308 @@
+# vim: sts=4:sw=4:et:tw=80:nosta
+"""Counters, gauges and latency histograms of the proxy.  Updating a metric is
+a single addition (a bisection for histograms), so they are always collected.
+They can be read in the Prometheus text format from a local HTTP endpoint (see
+serve()) or with the IRC STATS command."""
+import asyncio, config, functools, logging
+from bisect import bisect_left
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1, 2.5, 5, 10)
+
+class Counter:
+
+    """A value that only ever goes up."""
+
+    __slots__ = ("name", "help", "value")
+    type = "counter"
+
+    def __init__(self, name, help):
+        """Creates a new counter at 0.
+            :name: Name of the metric
+            :help: One line description of the metric
+
+        """
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        """Adds to the counter.
+            :n: Amount to add (default 1)
+
+        """
+        self.value += n
+
+    def samples(self):
+        """Returns the (name, value) pairs of the metric."""
+        return ((self.name, self.value),)
+
+    def dump(self):
+        """Returns the state of the metric, for merge()."""
+        return self.value
+
+    def merge(self, data):
+        """Adds the state dumped by the same metric of another process."""
+        self.value += data
+
+class Gauge:
+
+    """A value that goes up and down.  If a function is given, the value is
+    computed by calling it whenever the metric is read."""
+
+    __slots__ = ("name", "help", "value", "_func")
+    type = "gauge"
+
+    def __init__(self, name, help, func=None):
+        """Creates a new gauge at 0.
+            :name: Name of the metric
+            :help: One line description of the metric
+            :func: Function returning the value (default None)
+
+        """
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._func = func
+
+    def inc(self, n=1):
+        """Raises the gauge.
+            :n: Amount to add (default 1)
+
+        """
+        self.value += n
+
+    def dec(self, n=1):
+        """Lowers the gauge.
+            :n: Amount to subtract (default 1)
+
+        """
+        self.value -= n
+
+    def samples(self):
+        """Returns the (name, value) pairs of the metric."""
+        return ((self.name, self.dump()),)
+
+    def dump(self):
+        """Returns the state of the metric, for merge()."""
+        return self._func() if self._func else self.value
+
+    def merge(self, data):
+        """Adds the state dumped by the same metric of another process."""
+        self.value += data
+
+class Histogram:
+
+    """Counts observed values into buckets."""
+
+    __slots__ = ("name", "help", "buckets", "counts", "count", "sum")
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        """Creates a new, empty histogram.
+            :name: Name of the metric
+            :help: One line description of the metric
+            :buckets: Ascending upper bounds of the buckets (default
+                LATENCY_BUCKETS)
+
+        """
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Counts a value into its bucket.
+            :value: The observed value, e.g. a latency in seconds
+
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimates a quantile from the buckets.
+            :q: The quantile, between 0 and 1
+            :returns: The upper bound of the bucket holding the quantile, or
+                None if nothing was observed
+
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                break
+        return self.buckets[i] if i < len(self.buckets) else float("inf")
+
+    def samples(self):
+        """Returns the (name, value) pairs of the metric."""
+        out = []
+        seen = 0
+        for bound, n in zip(self.buckets + ("+Inf",), self.counts):
+            seen += n
+            out.append(('{}_bucket{{le="{}"}}'.format(self.name, bound), seen))
+        out.append((self.name + "_sum", self.sum))
+        out.append((self.name + "_count", self.count))
+        return out
+
+    def dump(self):
+        """Returns the state of the metric, for merge()."""
+        return [self.counts, self.sum, self.count]
+
+    def merge(self, data):
+        """Adds the state dumped by the same metric of another process."""
+        counts, total, count = data
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+        self.sum += total
+        self.count += count
+
+class Registry:
+
+    """Holds the metrics of the proxy, in the order they were created."""
+
+    def __init__(self):
+        """Creates a new registry without any metrics."""
+        self._metrics = []
+
+    def add(self, metric):
+        """Registers a metric.
+            :metric: A Counter, Gauge or Histogram
+            :returns: The metric
+
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def dump(self):
+        """Returns the state of all metrics as a JSON serialisable
+        dictionary, so that another process can merge them."""
+        return {m.name: m.dump() for m in self._metrics}
+
+    def merged(self, dumps):
+        """Builds a registry holding the sums of the dumps of several
+        processes.  Metrics unknown to this registry are ignored.
+            :dumps: Iterable of dictionaries returned by dump()
+            :returns: A new Registry
+
+        """
+        reg = Registry()
+        for m in self._metrics:
+            if m.type == "histogram":
+                total = Histogram(m.name, m.help, m.buckets)
+            else:
+                total = type(m)(m.name, m.help)
+            reg.add(total)
+            for d in dumps:
+                if m.name in d:
+                    total.merge(d[m.name])
+        return reg
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        out = []
+        for m in self._metrics:
+            out.append("# HELP {} {}\n# TYPE {} {}\n".format(m.name, m.help,
+                m.name, m.type))
+            for name, value in m.samples():
+                out.append("{} {}\n".format(name, value))
+        return "".join(out)
+
+    def summary(self):
+        """Returns one short line per metric, for the IRC STATS command."""
+        out = []
+        for m in self._metrics:
+            if m.type == "histogram":
+                p50 = m.quantile(0.5)
+                p99 = m.quantile(0.99)
+                out.append("{} count={} p50<={} p99<={}".format(m.name,
+                    m.count, p50, p99))
+            else:
+                out.append("{} {}".format(*m.samples()[0]))
+        return out
+
+registry = Registry()
+
+frames_in = registry.add(Counter("hitbox_frames_received_total",
+    "Websocket frames received from Hitbox"))
+frames_out = registry.add(Counter("hitbox_frames_sent_total",
+    "Websocket frames sent to Hitbox"))
+upstream_connects = registry.add(Counter("hitbox_upstream_connects_total",
+    "Websocket connections opened to Hitbox"))
+upstream_errors = registry.add(Counter("hitbox_upstream_errors_total",
+    "Failed attempts to connect to Hitbox"))
+upstream_closed = registry.add(Counter("hitbox_upstream_closed_total",
+    "Websocket connections closed by Hitbox"))
+upstream_reconnects = registry.add(Counter("hitbox_upstream_reconnects_total",
+    "Websocket connections reestablished after being closed by Hitbox"))
+sessions = registry.add(Gauge("hitbox_irc_sessions",
+    "Connected IRC clients"))
+clients = registry.add(Gauge("hitbox_clients",
+    "Channels currently joined by IRC sessions"))
+events_dropped = registry.add(Counter("hitbox_events_dropped_total",
+    "Events dropped by full channel queues"))
+events_coalesced = registry.add(Counter("hitbox_events_coalesced_total",
+    "Nick list snapshots replaced by a newer one in full channel queues"))
+events_paused = registry.add(Counter("hitbox_events_paused_total",
+    "Times a full channel queue made the websocket reader wait"))
+dedupe_hits = registry.add(Counter("hitbox_dedupe_hits_total",
+    "Chat messages recognised as already seen"))
+dedupe_misses = registry.add(Counter("hitbox_dedupe_misses_total",
+    "Chat messages checked for duplicates and not seen before"))
+delivery_latency = registry.add(Histogram("hitbox_delivery_seconds",
+    "Time from receiving a frame to writing it to the IRC client"))
+auth_latency = registry.add(Histogram("hitbox_auth_seconds",
+    "Time taken by Hitbox login requests"))
+
+@asyncio.coroutine
+def handle_request(source, reader, writer):
+    """Answers a single HTTP request for /metrics.
+        :source: Object whose render() returns the metrics
+        :reader: StreamReader of the connection
+        :writer: StreamWriter of the connection
+
+    """
+    try:
+        request = yield from reader.readline()
+        while (yield from reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.split()
+        if len(parts) > 1 and parts[1] == b"/metrics":
+            body = source.render().encode("UTF-8")
+            status = "200 OK"
+        else:
+            body = b"Not found\n"
+            status = "404 Not Found"
+        writer.write("HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4"
+            "\r\nContent-Length: {}\r\n\r\n".format(status, len(body))
+            .encode("ascii") + body)
+        yield from writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+@asyncio.coroutine
+def serve(host=None, port=None, source=None):
+    """Starts the metrics HTTP endpoint.
+        :host: Address to listen on (default config.metricsHost)
+        :port: Port to listen on (default config.metricsPort)
+        :source: Object whose render() returns the metrics (default
+            registry)
+        :returns: The asyncio server
+
+    """
+    host = config.metricsHost if host == None else host
+    port = config.metricsPort if port == None else port
+    source = registry if source == None else source
+    server = yield from asyncio.start_server(
+        functools.partial(handle_request, source), host, port)
+    logging.getLogger("main").info("Serving metrics on http://{}:{}/metrics"
+        .format(host, port))
+    return server
@@ -0,0 +1,260 @@
+# vim: sts=4:sw=4:et:tw=80:nosta
+"""Multi-process mode of the proxy.  A supervisor starts config.workers worker
+processes, each running its own event loop and IRC listener on the same port
+with SO_REUSEPORT, so that the kernel spreads new IRC connections over them.
+Workers send their metrics to the supervisor through a pipe; the supervisor
+serves the sums on the metrics endpoint.
+
+Send SIGHUP to the supervisor to restart the workers one at a time: a new
+worker is started before the old one stops accepting connections, and the
+old one exits once its clients are gone (or after config.workerDrainTimeout).
+SIGTERM stops all workers the same way, while SIGINT (Ctrl-C) stops them at
+once; a second SIGINT or SIGTERM kills workers that are still draining.
+
+Caches (login tokens, server list, shared channel subscriptions) are per
+worker, so sessions of one account may use more upstream connections than in
+single-process mode.  Requires SO_REUSEPORT (Linux 3.9 or later, or BSD)."""
+import asyncio, config, fcntl, json, logging, os, signal, sys
+import hitbox_http, hitbox_logging, hitbox_metrics
+# Registers the connection and queue gauges, so that the supervisor sums them
+import hitbox_irc_socket
+
+class WorkerStats:
+
+    """The latest metrics reported by each worker."""
+
+    def __init__(self):
+        """Creates a new, empty set of reports."""
+        self._dumps = {} # pid -> dictionary from Registry.dump()
+
+    def update(self, pid, dump):
+        """Stores the latest report of a worker.
+            :pid: Process ID of the worker
+            :dump: Dictionary from the worker's Registry.dump()
+
+        """
+        self._dumps[pid] = dump
+
+    def remove(self, pid):
+        """Forgets the report of a worker that exited.
+            :pid: Process ID of the worker
+
+        """
+        self._dumps.pop(pid, None)
+
+    def render(self):
+        """Returns the sums of the workers' metrics in the Prometheus text
+        format, followed by the number of workers reporting."""
+        reg = hitbox_metrics.registry.merged(self._dumps.values())
+        reg.add(hitbox_metrics.Gauge("hitbox_workers",
+            "Worker processes reporting metrics")).inc(len(self._dumps))
+        return reg.render()
+
+class Supervisor:
+
+    """Starts, watches and restarts the worker processes."""
+
+    def __init__(self, count=None):
+        """Creates a new supervisor.
+            :count: Number of workers, 0 for one per CPU (default
+                config.workers)
+
+        """
+        count = config.workers if count == None else count
+        self._count = count or os.cpu_count() or 1
+        self._workers = {} # pid -> asyncio subprocess
+        self._retiring = set() # pids of workers asked to stop
+        self._stats = WorkerStats()
+        self._stopping = False
+        self._restarting = False
+        self._log = logging.getLogger("main")
+
+    @asyncio.coroutine
+    def spawn(self):
+        """Starts a new worker process.
+            :returns: The asyncio subprocess
+
+        """
+        r, w = os.pipe()
+        try:
+            proc = yield from asyncio.create_subprocess_exec(sys.executable,
+                os.path.abspath(__file__), "worker", str(w), pass_fds=(w,))
+        finally:
+            os.close(w)
+        self._workers[proc.pid] = proc
+        self._log.info("Started worker {}".format(proc.pid))
+        buf = bytearray()
+        asyncio.get_event_loop().add_reader(r, self._read, proc.pid, r, buf)
+        asyncio.async(self.watch(proc, r))
+        return proc
+
+    def _read(self, pid, fd, buf):
+        """Reads the metrics reported by a worker.  Each report is one line
+        of JSON; only the latest complete one is kept."""
+        data = os.read(fd, 65536)
+        if not data:
+            asyncio.get_event_loop().remove_reader(fd)
+            return
+        buf += data
+        end = buf.rfind(b"\n")
+        if end < 0:
+            return
+        start = buf.rfind(b"\n", 0, end) + 1
+        try:
+            self._stats.update(pid, json.loads(buf[start:end].decode()))
+        except ValueError:
+            self._log.warning("Bad metrics from worker {}".format(pid))
+        del buf[:end + 1]
+
+    @asyncio.coroutine
+    def watch(self, proc, fd):
+        """Waits for a worker to exit, and replaces it if it was not asked
+        to stop."""
+        code = yield from proc.wait()
+        loop = asyncio.get_event_loop()
+        loop.remove_reader(fd)
+        os.close(fd)
+        del self._workers[proc.pid]
+        self._stats.remove(proc.pid)
+        if proc.pid in self._retiring:
+            self._retiring.discard(proc.pid)
+            self._log.info("Worker {} stopped".format(proc.pid))
+        elif not self._stopping:
+            self._log.warning("Worker {} exited with {}, replacing it"
+                .format(proc.pid, code))
+            yield from asyncio.sleep(1)
+            if not self._stopping:
+                yield from self.spawn()
+
+    def retire(self, proc):
+        """Asks a worker to stop accepting connections and exit once its
+        clients are gone."""
+        self._retiring.add(proc.pid)
+        proc.send_signal(signal.SIGTERM)
+
+    @asyncio.coroutine
+    def restart(self):
+        """Replaces every worker with a new one, one at a time."""
+        if self._restarting or self._stopping:
+            return
+        self._restarting = True
+        self._log.info("Restarting workers")
+        try:
+            for pid, proc in list(self._workers.items()):
+                if pid in self._retiring or self._stopping:
+                    continue
+                yield from self.spawn()
+                # Give the new worker time to start listening
+                yield from asyncio.sleep(1)
+                self.retire(proc)
+        finally:
+            self._restarting = False
+
+    @asyncio.coroutine
+    def stop(self, drain=True):
+        """Stops all workers and waits for them to exit.  If the workers are
+        already stopping, they are killed instead.
+            :drain: Whether the workers wait for their clients to leave;
+                otherwise they exit at once (default True)
+
+        """
+        if self._stopping:
+            self._log.warning("Killing workers")
+            for proc in self._workers.values():
+                proc.kill()
+            return
+        self._stopping = True
+        procs = list(self._workers.values())
+        for proc in procs:
+            if not drain:
+                self._retiring.add(proc.pid)
+                proc.send_signal(signal.SIGINT)
+            elif proc.pid not in self._retiring:
+                self.retire(proc)
+        for proc in procs:
+            yield from proc.wait()
+        asyncio.get_event_loop().stop()
+
+    def run(self):
+        """Starts the workers and supervises them until SIGINT or SIGTERM."""
+        loop = asyncio.get_event_loop()
+        for i in range(self._count):
+            loop.run_until_complete(self.spawn())
+        metrics = None
+        if config.metricsPort:
+            metrics = loop.run_until_complete(
+                hitbox_metrics.serve(source=self._stats))
+        loop.add_signal_handler(signal.SIGHUP,
+            lambda: asyncio.async(self.restart()))
+        loop.add_signal_handler(signal.SIGINT,
+            lambda: asyncio.async(self.stop(drain=False)))
+        loop.add_signal_handler(signal.SIGTERM,
+            lambda: asyncio.async(self.stop()))
+        self._log.info("Supervising {} workers".format(self._count))
+        try:
+            loop.run_forever()
+        finally:
+            if metrics != None:
+                metrics.close()
+                loop.run_until_complete(metrics.wait_closed())
+            loop.close()
+
+@asyncio.coroutine
+def report(fd):
+    """Sends this worker's metrics to the supervisor every
+    config.workerStatsInterval seconds."""
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+        os.O_NONBLOCK)
+    while True:
+        data = (json.dumps(hitbox_metrics.registry.dump()) + "\n") \
+            .encode("UTF-8")
+        try:
+            os.write(fd, data)
+        except BlockingIOError:
+            pass # the supervisor is busy; it only needs the latest report
+        except BrokenPipeError:
+            return
+        yield from asyncio.sleep(config.workerStatsInterval)
+
+@asyncio.coroutine
+def drain(server):
+    """Stops accepting connections, then waits for the connected clients to
+    leave, for at most config.workerDrainTimeout seconds."""
+    log = logging.getLogger("main")
+    log.info("Worker {} draining".format(os.getpid()))
+    server.close()
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + config.workerDrainTimeout
+    while hitbox_metrics.sessions.value > 0 and loop.time() < deadline:
+        yield from asyncio.sleep(1)
+    loop.stop()
+
+def worker(fd):
+    """Runs a worker process.
+        :fd: Write end of the pipe to the supervisor
+
+    """
+    from hitbox_irc_server import IRCServerProtocol
+    hitbox_logging.setup(["irc", "asyncio", "main", "token", "ws", "http"])
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(loop.create_server(IRCServerProtocol,
+        port=config.ircPort, reuse_port=True))
+    reporter = asyncio.async(report(fd))
+    # The supervisor stops us with SIGINT (at once) or SIGTERM (draining);
+    # Ctrl-C in a terminal reaches the supervisor and us alike
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    loop.add_signal_handler(signal.SIGTERM,
+        lambda: asyncio.async(drain(server)))
+    try:
+        loop.run_forever()
+    finally:
+        reporter.cancel()
+        loop.run_until_complete(hitbox_http.close())
+        loop.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "worker":
+        worker(int(sys.argv[2]))
+    else:
+        hitbox_logging.setup(["asyncio", "main"])
+        Supervisor().run()